@@ -18,6 +18,7 @@ from gettext import gettext as _
 from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import GConf
+from gi.repository import GObject
 
 from gi.repository import SugarExt
 
@@ -43,6 +44,8 @@ from taskmaster import TaskMaster
 from graphics import Graphics, FONT_SIZES
 import utils
 from power import get_power_manager
+from reporter import deliver_report, deliver_reports, LogPrecollector
+from backend.outbox import Outbox, OutboxSender
 
 import logging
 _logger = logging.getLogger('one-support-activity')
@@ -101,10 +104,25 @@ class OneSupportActivity(activity.Activity):
         self._fixed = None
         self._notify_transfer_status = False
 
+        # Reports that could not be sent before are retried in the
+        # background for as long as the activity runs.
+        GObject.threads_init()
+        self.outbox = Outbox()
+        self.outbox_sender = OutboxSender(self.outbox, deliver_report,
+                                          deliver_reports)
+        self.outbox_sender.start()
+
+        # The logs are archived while the user fills in the report, so
+        # submitting it only has to add what they gained meanwhile.
+        self.precollector = LogPrecollector()
+        self.precollector.start()
+
         get_power_manager().inhibit_suspend()
         self._launch_task_master()
 
     def can_close(self):
+        self.outbox_sender.stop()
+        self.precollector.discard()
         get_power_manager().restore_suspend()
         return True
 
@@ -0,0 +1,263 @@
+# Copyright (c) 2014 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+"""Send reports without the activity, e.g. from a whole lab of XOs
+
+Usage:
+    python -m backend.batch send [options]
+                        - collect the logs of this XO and file a ticket
+    python -m backend.batch spool DIR [options]
+                        - collect the logs and keep the report in DIR, to
+                          be delivered later from this or another machine
+    python -m backend.batch deliver DIR [--workers N] [options]
+                        - deliver the reports kept in DIR, N at a time
+
+The report fields come from --json FILE, overridden by --subject, --body,
+--name, --email, --school, --phone, --serial, --build and --attach.
+--url, --token and --fields replace the GConf settings.
+
+One JSON line is printed per report, with its id, result, error, seconds,
+seconds per phase and the attachments that could not be uploaded.
+"""
+
+import os
+import sys
+import json
+import uuid
+import Queue
+import argparse
+import mimetypes
+import threading
+
+from backend.logcollect import MachineProperties, monotonic
+from backend.zendesk import ZendeskConfig, ConfigError, get_config
+from backend.zendesk import set_config, configure_session
+from backend.outbox import Outbox
+from backend.metrics import Metrics
+
+# How many spooled reports deliver sends at the same time
+BATCH_WORKERS = 4
+
+FIELDS = ['subject', 'body', 'name', 'email', 'school', 'phone', 'serial',
+          'build']
+
+_print_lock = threading.Lock()
+
+
+def _file(path):
+    path = os.path.abspath(path)
+    return {'path': path,
+            'name': os.path.basename(path),
+            'type': mimetypes.guess_type(path)[0] or
+            'application/octet-stream'}
+
+
+def report_data(args):
+    """Return the send_report data the command line asks for"""
+    data = {}
+    if args.json:
+        with open(args.json) as f:
+            data = json.load(f)
+
+    for field in FIELDS:
+        value = getattr(args, field)
+        if value is not None:
+            data[field] = value
+
+    machine = MachineProperties()
+    data.setdefault('subject', 'bug report from One Support')
+    data.setdefault('body', '')
+    for field in ['name', 'email', 'school', 'phone']:
+        data.setdefault(field, '')
+    if not data.get('serial'):
+        data['serial'] = machine.laptop_serial_number()
+    if not data.get('build'):
+        data['build'] = machine.build_information()
+
+    # Files are given as paths, or as file dicts as in send_report
+    files = []
+    for file in data.get('files', []) + args.attach:
+        if isinstance(file, basestring):
+            files.append(_file(file))
+        else:
+            files.append(file)
+    data['files'] = files
+    data.setdefault('key', uuid.uuid4().hex)
+    return data
+
+
+def configure(args):
+    """Use the --url, --token and --fields given, with the GConf
+    settings for the ones not given"""
+    if not (args.url or args.token or args.fields):
+        return
+    try:
+        config = get_config()
+    except Exception:
+        config = ZendeskConfig(None, None, None)
+
+    url = args.url or config.url
+    token = args.token or config.token
+    fields = config.fields
+    if args.fields:
+        try:
+            fields = tuple([int(field) for field in args.fields.split(',')])
+        except ValueError:
+            raise ConfigError('--fields must be numbers separated by commas')
+    if not url or not token or not fields:
+        raise ConfigError('--url, --token and --fields are all needed '
+                          'without GConf settings')
+    set_config(ZendeskConfig(url, token, fields))
+
+
+def summary(report_id, metrics, error=None, failed=None, result=None):
+    """Return the JSON line printed for a report"""
+    record = json.loads(metrics.dumps())
+    if result is None:
+        result = error is None and 'sent' or error.__class__.__name__
+    return json.dumps({'id': report_id,
+                       'result': result,
+                       'error': error is not None and str(error) or None,
+                       'seconds': record['seconds'],
+                       'phases': record['phases'],
+                       'failed': [file['name'] for file, e in failed or []]},
+                      sort_keys=True)
+
+
+def _print(line):
+    with _print_lock:
+        print line
+        sys.stdout.flush()
+
+
+def send(args):
+    from reporter import send_report
+
+    data = report_data(args)
+    metrics = Metrics(data['key'])
+    try:
+        failed = send_report(data, metrics=metrics)
+    except Exception as error:
+        _print(summary(data['key'], metrics, error))
+        return 1
+    _print(summary(data['key'], metrics, failed=failed))
+    return 0
+
+
+def spool(args):
+    from reporter import collect_logs
+
+    data = report_data(args)
+    metrics = Metrics(data['key'])
+    with metrics.phase('collect'):
+        collector, archive = collect_logs()
+    try:
+        data['files'].append({'path': archive,
+                              'name': 'logs.zip',
+                              'type': 'application/zip'})
+        report_id = Outbox(args.directory).spool(data)
+    finally:
+        os.remove(archive)
+    # The outbox has these logs now, they will not be lost
+    collector.commit_checkpoints()
+    _print(summary(report_id, metrics, result='spooled'))
+    return 0
+
+
+def deliver(args):
+    from reporter import deliver_report
+
+    outbox = Outbox(args.directory)
+    pending = Queue.Queue()
+    for report_id in outbox.ids():
+        pending.put(report_id)
+    errors = []
+
+    # Every report uploads on several threads of its own
+    configure_session(max_conns=args.workers * 2)
+
+    def work():
+        while True:
+            try:
+                report_id = pending.get_nowait()
+            except Queue.Empty:
+                return
+            metrics = Metrics(report_id)
+            failed = []
+
+            def deliver_one(report):
+                failed.extend(deliver_report(report, metrics=metrics))
+
+            try:
+                error = outbox.send(report_id, deliver_one)
+            except Exception as e:
+                error = e
+            if error is not None:
+                errors.append(error)
+            metrics.set('result', error is None and 'sent' or
+                        error.__class__.__name__)
+            try:
+                metrics.save()
+            except (IOError, OSError):
+                pass
+            _print(summary(report_id, metrics, error, failed))
+
+    threads = [threading.Thread(target=work)
+               for i in range(min(args.workers, pending.qsize()))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors and 1 or 0
+
+
+COMMANDS = {'send': send, 'spool': spool, 'deliver': deliver}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog='python -m backend.batch',
+        description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=sorted(COMMANDS.keys()))
+    parser.add_argument('directory', nargs='?',
+                        help='outbox directory for spool and deliver')
+    parser.add_argument('--json', help='JSON file with the report fields')
+    for field in FIELDS:
+        parser.add_argument('--' + field)
+    parser.add_argument('--attach', action='append', default=[],
+                        help='file to attach, may be repeated')
+    parser.add_argument('--workers', type=int, default=BATCH_WORKERS,
+                        help='reports deliver sends at the same time')
+    parser.add_argument('--url', help='Zendesk URL')
+    parser.add_argument('--token', help='Zendesk API token')
+    parser.add_argument('--fields',
+                        help='Zendesk custom field ids, separated by commas')
+    args = parser.parse_args(argv[1:])
+
+    if args.command in ['spool', 'deliver'] and not args.directory:
+        parser.error('%s needs a directory' % args.command)
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+
+    try:
+        configure(args)
+    except ConfigError as error:
+        parser.error(str(error))
+
+    started = monotonic()
+    status = COMMANDS[args.command](args)
+    sys.stderr.write('%s done in %.1fs\n' % (args.command,
+                                             monotonic() - started))
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,615 @@
+# Copyright (c) 2014 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+"""Benchmarks for the report pipeline, to be run on the XO itself
+
+Usage:
+    python -m backend.benchmark codecs [logfile ...]
+                        - compression ratio and seconds per MB for each
+                          log archive codec, on the given files or the
+                          logs LogCollect would collect
+
+    python -m backend.benchmark probes [rounds]
+                        - wall time and peak RSS of the /proc readers
+                          against the shell tools they replace
+
+    python -m backend.benchmark report [options]
+                        - send a report with send_report to the stand-in
+                          Zendesk server (or --url) and print the timings
+                          of every phase and request it records, see
+                          --help for latency, bandwidth and errors
+
+    python -m backend.benchmark memory archive [MB] [limit MB]
+                        - archive a generated log of MB (default 200)
+                          with write_logs and fail if the peak RSS grew
+                          by more than limit MB (default 32)
+
+    python -m backend.benchmark memory upload [MB] [limit MB]
+                        - upload a file of MB (default bigger than the
+                          RAM of this machine) with Attachment.create to
+                          the stand-in Zendesk server over Soup, failing
+                          the same or if the body arrives changed
+
+    python -m backend.benchmark drain [reports] [item errors]
+                        - drain an outbox of reports (default 50) into the
+                          stand-in Zendesk server a ticket at a time and
+                          in create_many batches, a fraction item errors
+                          of the batched tickets failing (default 0.2),
+                          then check that a batch job outliving its wait
+                          does not create duplicates on the next flush
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import uuid
+import hashlib
+import shutil
+import zipfile
+import argparse
+import resource
+import mimetypes
+from ConfigParser import ConfigParser
+from tempfile import NamedTemporaryFile, mkdtemp
+
+from backend.logcollect import LogCollect, MachineProperties, Probe
+from backend.logcollect import pick_codec, _write_chunks, CHECKPOINT_PATH
+from backend.zendesk import Attachment, ZendeskConfig, set_config
+from backend.zendesk import JobStatus, NetworkError, ServerError
+from backend.uploadcache import UPLOAD_CACHE_PATH
+from backend.metrics import Metrics, METRICS_PATH
+from backend.outbox import Outbox
+from backend import standin
+
+BENCH_CODECS = ['store', 'deflate:1', 'deflate:6', 'deflate:9',
+                'bzip2:1', 'bzip2:9', 'auto']
+
+MB = 1024.0 * 1024.0
+
+# Reports drain spools, the fraction of batched tickets the stand-in
+# fails, and the seconds between job polls against it
+DRAIN_REPORTS = 50
+DRAIN_ITEM_ERRORS = 0.2
+DRAIN_POLL_INTERVAL = 0.1
+# How long a job takes in the job timeout check, and how long
+# JobStatus waits for it there
+DRAIN_JOB_DELAY = 2.0
+DRAIN_JOB_TIMEOUT = 0.5
+
+# Size of the generated file and how much the peak RSS may grow while
+# it is handled, for the memory checks
+MEMORY_FILE_MB = 200
+MEMORY_LIMIT_MB = 32
+
+
+def sample_logs():
+    """Return the log files LogCollect would include in a report"""
+    paths = []
+    for fn in ['dmesg', 'messages', 'cron', 'maillog', 'rpmpkgs',
+               'Xorg.0.log', 'spooler']:
+        if os.access('/var/log/' + fn, os.R_OK):
+            paths.append('/var/log/' + fn)
+    home = os.path.expanduser('~')
+    paths.extend(glob.glob(os.path.join(home, '.sugar', 'default', 'logs',
+                                        '*.log')))
+    return paths
+
+
+def bench_codecs(paths, codecs=BENCH_CODECS):
+    """Archive paths once per codec, return (codec, ratio, s/MB) rows"""
+    collector = LogCollect()
+    raw = sum([os.path.getsize(path) for path in paths])
+    rows = []
+
+    for codec in codecs:
+        tmp = NamedTemporaryFile(suffix='.zip', delete=False)
+        tmp.close()
+        try:
+            start = time.time()
+            z = zipfile.ZipFile(tmp.name, 'w', allowZip64=True)
+            for path in paths:
+                size = os.path.getsize(path)
+                _write_chunks(z, os.path.basename(path),
+                              collector.file_chunks(path, 0),
+                              size_hint=size,
+                              codec=pick_codec(codec, path, size))
+            z.close()
+            elapsed = time.time() - start
+            packed = os.path.getsize(tmp.name)
+        finally:
+            os.remove(tmp.name)
+
+        rows.append((codec, raw / float(max(packed, 1)),
+                     elapsed / max(raw / MB, 1e-9)))
+
+    return raw, rows
+
+
+def in_child(function, *args):
+    """Call function in a forked child and return what it returned, so
+    its peak RSS is not hidden by whatever this process peaked at before
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            os.write(write_fd, json.dumps(function(*args)))
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        result = f.read()
+    os.waitpid(pid, 0)
+    return json.loads(result)
+
+
+def _native_peak(reader, rounds):
+    for i in range(rounds):
+        reader()
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _shell_peak(cmd, rounds):
+    for i in range(rounds):
+        Probe(cmd).result(60)
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+
+def _fork_peak():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def bench_probes(rounds=5):
+    """Time each /proc reader against its shell tool
+
+    Returns rows of (report, native s/call, shell s/call, native KB,
+    shell KB).  The KB figures are peak RSS, each measured in a fresh
+    fork of this interpreter: one running the reader, one starting the
+    tools.  A tool is exec'd from such a fork and the kernel carries
+    its peak over, so both figures sit on the same base, fork_peak().
+    """
+    machine = MachineProperties()
+    pairs = [('ifconfig', machine.native_ifconfig, machine.IFCONFIG),
+             ('route -n', machine.native_route_n, machine.ROUTE),
+             ('df -a', machine.native_df_a, machine.DF),
+             ('ps auxfwww', machine.native_ps, machine.PS),
+             ('free', machine.native_free, machine.FREE)]
+    rows = []
+    for name, reader, cmd in pairs:
+        start = time.time()
+        for i in range(rounds):
+            reader()
+        native = (time.time() - start) / rounds
+        start = time.time()
+        for i in range(rounds):
+            Probe(cmd).result(60)
+        shell = (time.time() - start) / rounds
+        rows.append((name, native, shell,
+                     in_child(_native_peak, reader, rounds),
+                     in_child(_shell_peak, cmd, rounds)))
+    return rows
+
+
+def fork_peak():
+    """Return the peak RSS in KB of a fork of this interpreter that
+    does nothing, the base under the figures of bench_probes"""
+    return in_child(_fork_peak)
+
+
+def rss_kb():
+    """Return the current resident set size of this process in KB"""
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * resource.getpagesize() / 1024
+
+
+def generate_log(path, size):
+    """Write size bytes of syslog-like lines to path, a line at a time"""
+    written = 0
+    with open(path, 'wb') as f:
+        while written < size:
+            line = ('Oct 18 01:14:%02d xo-1a-2b-3c kernel: [%12.6f] '
+                    'usb 1-1: reset high-speed USB device number %d\n' %
+                    (written % 60, written / 1e6, written % 127))
+            f.write(line)
+            written += len(line)
+
+
+def measure_peak(function, *args):
+    """Call function, return how many KB the peak RSS grew above the
+    RSS before the call, an upper bound of what it held at once"""
+    before = rss_kb()
+    function(*args)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+
+
+def bench_archive_memory(size):
+    """Archive a generated log of size bytes with write_logs, return
+    (archive bytes, seconds, peak RSS growth in KB)"""
+    collector = LogCollect()
+    collector.laptop_info = lambda: ''
+
+    log = NamedTemporaryFile(suffix='.log', delete=False)
+    log.close()
+    tmp = NamedTemporaryFile(suffix='.zip', delete=False)
+    tmp.close()
+    try:
+        generate_log(log.name, size)
+        collector._logs = lambda: [(log.name, 'var-log/messages')]
+        start = time.time()
+        growth = measure_peak(collector.write_logs, tmp.name, 0)
+        return os.path.getsize(tmp.name), time.time() - start, growth
+    finally:
+        os.remove(log.name)
+        os.remove(tmp.name)
+
+
+def ram_mb():
+    """Return the MB of RAM of this machine"""
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1]) / 1024
+    return MEMORY_FILE_MB
+
+
+def zeros_sha1(size):
+    """Return the sha1 hexdigest of size zero bytes"""
+    digest = hashlib.sha1()
+    block = '\0' * int(MB)
+    while size > 0:
+        digest.update(block[:size])
+        size -= len(block)
+    return digest.hexdigest()
+
+
+def bench_upload_memory(size):
+    """Upload a file of size bytes to a stand-in Zendesk server with
+    Attachment.create, return (bytes received, seconds, peak RSS growth
+    in KB); the stand-in runs in this process and only hashes what it
+    receives.  The upload goes through the Soup session like a report
+    does, and raises ValueError if the body arrived changed."""
+    server = standin.start(standin.ZendeskStandIn)
+    set_config(ZendeskConfig('http://127.0.0.1:%d' % server.server_port,
+                             'c3RhbmQtaW4=', tuple(range(7))))
+
+    # Sparse, so a file bigger than the RAM does not fill the disk
+    tmp = NamedTemporaryFile(suffix='.bin', delete=False)
+    tmp.truncate(size)
+    tmp.close()
+    try:
+        attachment = Attachment()
+        start = time.time()
+        growth = measure_peak(attachment.create, tmp.name, 'big.bin',
+                              'application/octet-stream')
+        seconds = time.time() - start
+        filename, received, digest = server.uploads[attachment.token()]
+        if received != size or digest != zeros_sha1(size):
+            raise ValueError('stand-in received %d bytes, sha1 %s, of %d '
+                             'zero bytes' % (received, digest, size))
+        return received, seconds, growth
+    finally:
+        os.remove(tmp.name)
+        server.shutdown()
+
+
+def memory_main(argv):
+    checks = {'archive': bench_archive_memory,
+              'upload': bench_upload_memory}
+    if not argv or argv[0] not in checks:
+        print __doc__
+        return 1
+    size = MEMORY_FILE_MB
+    if argv[0] == 'upload':
+        size = ram_mb() + 64
+    limit = MEMORY_LIMIT_MB
+    if len(argv) > 1:
+        size = int(argv[1])
+    if len(argv) > 2:
+        limit = int(argv[2])
+
+    packed, seconds, growth = checks[argv[0]](int(size * MB))
+    print '%s of %d MB: %d bytes in %.1fs, peak RSS grew %d K' % (
+        argv[0], size, packed, seconds, growth)
+    if growth > limit * 1024:
+        print 'FAIL: more than the %d MB allowed' % limit
+        return 1
+    print 'OK: within %d MB' % limit
+    return 0
+
+
+def spool_reports(outbox, count):
+    """Spool count reports without attachments into outbox"""
+    for i in range(count):
+        outbox.spool({'subject': 'benchmark %d' % i,
+                      'body': 'benchmark',
+                      'name': 'Benchmark',
+                      'email': 'benchmark@example.com',
+                      'school': 'benchmark',
+                      'phone': '',
+                      'serial': 'SHC00000000',
+                      'build': 'benchmark',
+                      'files': [],
+                      'key': uuid.uuid4().hex})
+
+
+def start_zendesk(**kwargs):
+    """Start a stand-in Zendesk server and send reports to it"""
+    server = standin.start(standin.ZendeskStandIn, **kwargs)
+    set_config(ZendeskConfig('http://127.0.0.1:%d' % server.server_port,
+                             'c3RhbmQtaW4=', tuple(range(7))))
+    return server
+
+
+def bench_drain(count, batched, item_errors=0.0):
+    """
+    Drain an outbox of count reports into a stand-in Zendesk server,
+    with Outbox.flush_many and deliver_reports if batched, else with
+    Outbox.flush and deliver_report.
+
+    Returns (seconds, requests, tickets created, reports left).
+    """
+    from reporter import deliver_report, deliver_reports
+
+    server = start_zendesk(item_errors=item_errors)
+    directory = mkdtemp()
+    try:
+        outbox = Outbox(directory)
+        spool_reports(outbox, count)
+        requests = server.requests
+        start = time.time()
+        if batched:
+            outbox.flush_many(deliver_reports, force=True)
+        else:
+            outbox.flush(deliver_report, force=True)
+        return (time.time() - start, server.requests - requests,
+                len(server.tickets), len(outbox.ids()))
+    finally:
+        shutil.rmtree(directory)
+        server.shutdown()
+
+
+def check_drain_job_timeout(count):
+    """
+    Drain an outbox of count reports whose create_many job is still
+    working when JobStatus gives up, then, once the job created the
+    tickets anyway, drain it again with one more report.
+
+    Returns (reports left after the first flush, tickets created in
+    the end); count + 1 tickets means none were created twice.
+    """
+    from reporter import deliver_reports
+
+    server = start_zendesk(job_delay=DRAIN_JOB_DELAY)
+    directory = mkdtemp()
+    timeout = JobStatus.POLL_TIMEOUT
+    try:
+        outbox = Outbox(directory)
+        spool_reports(outbox, count)
+        JobStatus.POLL_TIMEOUT = DRAIN_JOB_TIMEOUT
+        outbox.flush_many(deliver_reports, force=True)
+        left = len(outbox.ids())
+
+        while len(server.tickets) < count:
+            time.sleep(DRAIN_POLL_INTERVAL)
+        spool_reports(outbox, 1)
+        outbox.flush_many(deliver_reports, force=True)
+        while [job for job in server.jobs.values()
+               if job['results'] is None]:
+            time.sleep(DRAIN_POLL_INTERVAL)
+        return left, len(server.tickets)
+    finally:
+        JobStatus.POLL_TIMEOUT = timeout
+        shutil.rmtree(directory)
+        server.shutdown()
+
+
+def drain_main(argv):
+    count = DRAIN_REPORTS
+    item_errors = DRAIN_ITEM_ERRORS
+    if len(argv) > 0:
+        count = int(argv[0])
+    if len(argv) > 1:
+        item_errors = float(argv[1])
+    # The stand-in runs a job a fraction of a second after it is queued
+    JobStatus.POLL_INTERVAL = DRAIN_POLL_INTERVAL
+
+    status = 0
+    print '%-10s %9s %9s %9s %9s' % ('mode', 'seconds', 'requests',
+                                     'tickets', 'left')
+    for name, batched, errors in [('single', False, 0.0),
+                                  ('batched', True, item_errors)]:
+        seconds, requests, tickets, left = bench_drain(count, batched,
+                                                       errors)
+        print '%-10s %9.2f %9d %9d %9d' % (name, seconds, requests,
+                                           tickets, left)
+        if tickets != count or left:
+            status = 1
+
+    left, tickets = check_drain_job_timeout(3)
+    print 'job timeout: %d of 3 left after the first flush, %d tickets ' \
+        'for 4 reports in the end' % (left, tickets)
+    if left != 3 or tickets != 4:
+        status = 1
+
+    print status and 'FAIL: tickets missing or created twice' or 'OK'
+    return status
+
+
+def bundle_version():
+    info = ConfigParser()
+    info.read(os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'activity', 'activity.info'))
+    try:
+        return info.get('Activity', 'activity_version')
+    except Exception:
+        return 'unknown'
+
+
+def preserved(paths):
+    """Return a function that puts the files at paths back as they are
+    now, removing those that do not exist yet"""
+    saved = {}
+    for path in paths:
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                saved[path] = f.read()
+
+    def restore():
+        for path in paths:
+            if path in saved:
+                with open(path, 'wb') as f:
+                    f.write(saved[path])
+            elif os.path.exists(path):
+                os.remove(path)
+    return restore
+
+
+def bench_report(url, attachments):
+    """
+    Send a report with send_report() to the Zendesk API at url, as the
+    activity does: the logs archived within LOG_BUDGET while the
+    attachments upload, then the ticket.
+
+    Returns the record its Metrics kept: seconds per phase and the
+    status, bytes and seconds of every request.  Log checkpoints, the
+    upload cache and the metrics file are put back as they were.
+    """
+    from reporter import send_report
+
+    set_config(ZendeskConfig(url, 'c3RhbmQtaW4=', tuple(range(7))))
+    data = {'subject': 'benchmark',
+            'body': 'benchmark',
+            'name': 'Benchmark',
+            'email': 'benchmark@example.com',
+            'school': 'benchmark',
+            'phone': '',
+            'serial': 'SHC00000000',
+            'build': 'benchmark',
+            'files': [{'path': path,
+                       'name': os.path.basename(path),
+                       'type': mimetypes.guess_type(path)[0] or
+                       'application/octet-stream'}
+                      for path in attachments]}
+    metrics = Metrics()
+    restore = preserved([CHECKPOINT_PATH, UPLOAD_CACHE_PATH, METRICS_PATH])
+    try:
+        send_report(data, metrics=metrics)
+    except (NetworkError, ServerError):
+        pass
+    finally:
+        restore()
+    return json.loads(metrics.dumps())
+
+
+def report_main(argv):
+    parser = argparse.ArgumentParser(prog='python -m backend.benchmark report')
+    parser.add_argument('--url', help='Zendesk to use instead of a stand-in')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--bandwidth', type=int, default=0,
+                        help='bytes per second, 0 for no limit')
+    parser.add_argument('--errors', type=float, default=0.0)
+    parser.add_argument('--status', type=int, default=503)
+    parser.add_argument('--attach', action='append', default=[],
+                        help='file to attach, may be repeated')
+    parser.add_argument('--json', metavar='FILE',
+                        help='append the results as a JSON line to FILE')
+    args = parser.parse_args(argv)
+
+    server = None
+    url = args.url
+    if url is None:
+        server = standin.start(standin.ZendeskStandIn,
+                               latency=args.latency,
+                               bandwidth=args.bandwidth,
+                               errors=args.errors, status=args.status)
+        url = 'http://127.0.0.1:%d' % server.server_port
+
+    record = bench_report(url, args.attach)
+
+    print '%-24s %9s %12s %10s' % ('phase', 'seconds', 'bytes', 'KB/s')
+    for phase in ['collect', 'upload', 'ticket']:
+        if phase in record['phases']:
+            print '%-24s %9.3f' % (phase, record['phases'][phase])
+    for request in record['requests']:
+        name = '%s %s' % (request.get('status', 'skipped'),
+                          request.get('name', request.get('path', '')))
+        rate = ''
+        if request.get('bytes_per_second'):
+            rate = '%.1f' % (request['bytes_per_second'] / 1024.0)
+        print '  %-22s %9.3f %12d %10s' % (name[:22],
+                                           request.get('seconds', 0),
+                                           request.get('bytes', 0), rate)
+    print '%-24s %9.3f' % ('total', record['seconds'])
+    print 'result: %s, archive %d bytes, connections opened: %d' % (
+        record.get('result'), record.get('archive', {}).get('compressed', 0),
+        record.get('connections', 0))
+
+    if args.json:
+        record.update({'version': bundle_version(),
+                       'url': args.url or 'stand-in',
+                       'latency': args.latency,
+                       'bandwidth': args.bandwidth})
+        with open(args.json, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    if server is not None:
+        server.shutdown()
+    return 0
+
+
+def main(argv):
+    if len(argv) > 1 and argv[1] == 'report':
+        return report_main(argv[2:])
+
+    if len(argv) > 1 and argv[1] == 'memory':
+        return memory_main(argv[2:])
+
+    if len(argv) > 1 and argv[1] == 'drain':
+        return drain_main(argv[2:])
+
+    if len(argv) > 1 and argv[1] == 'probes':
+        rounds = 5
+        if len(argv) > 2:
+            rounds = int(argv[2])
+        print '%-12s %10s %10s %12s %12s' % ('report', 'native s',
+                                            'shell s', 'native KB',
+                                            'shell KB')
+        for name, native, shell, native_rss, shell_rss in \
+                bench_probes(rounds):
+            print '%-12s %10.4f %10.4f %10d K %10d K' % (
+                name, native, shell, native_rss, shell_rss)
+        print ('KB: peak RSS of a fresh child running the reader (native) '
+               'or the tools (shell), from %d K idle' % fork_peak())
+        return 0
+
+    if len(argv) < 2 or argv[1] != 'codecs':
+        print __doc__
+        return 1
+
+    paths = argv[2:] or sample_logs()
+    if not paths:
+        print 'No logs to benchmark'
+        return 1
+
+    raw, rows = bench_codecs(paths)
+    print '%d files, %.2f MB' % (len(paths), raw / MB)
+    print '%-10s %8s %8s' % ('codec', 'ratio', 's/MB')
+    for codec, ratio, spm in rows:
+        print '%-10s %8.2f %8.3f' % (codec, ratio, spm)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
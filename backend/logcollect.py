@@ -46,9 +46,21 @@ import glob
 import sys
 import time
 import re
+import random
+import zlib
+import bz2
+import json
+import hashlib
+import signal
+import subprocess
+import threading
+import struct
+import fcntl
+import pwd
 
 # The next couple are used by LogSend
 import httplib
+import socket
 import mimetypes
 import urlparse
 
@@ -57,11 +69,466 @@ from gi.repository import GConf
 
 MFG_DATA_PATHS = ['/ofw/mfg-data/', '/proc/device-tree/mfg-data/']
 
+# Logs are copied into the archive in pieces of this size, so memory use
+# does not depend on how big the log files are.
+CHUNK_SIZE = 32768
+
+# Compression of archive members.  A codec is named 'store', 'deflate',
+# 'bzip2' or 'auto', optionally followed by a level: 'deflate:1'.  bzip2
+# members use zip method 12, which Python 2's zipfile cannot write itself
+# but unzip, 7-Zip and Python 3 read fine.
+ZIP_BZIP2 = 12
+CODECS = {'store': (zipfile.ZIP_STORED, None),
+          'deflate': (zipfile.ZIP_DEFLATED, zlib.Z_DEFAULT_COMPRESSION),
+          'bzip2': (ZIP_BZIP2, 9)}
+DEFAULT_CODEC = 'deflate'
+
+# What 'auto' does: already compressed files are stored, big files get a
+# cheap deflate so a slow XO is not stuck on them, the rest the best one.
+COMPRESSED_SUFFIXES = ['.gz', '.bz2', '.xz', '.zip', '.xo', '.xol', '.png',
+                       '.jpg', '.jpeg', '.ogg', '.ogv', '.webm', '.mp3']
+AUTO_FAST_SIZE = 1024 * 1024
+AUTO_FAST_CODEC = 'deflate:1'
+AUTO_BEST_CODEC = 'deflate:9'
+
+
+def parse_codec(codec):
+    """Return (zip compression method, level) for a codec name"""
+    name, sep, level = codec.partition(':')
+    if name not in CODECS:
+        raise ValueError('unknown codec %s' % codec)
+
+    method, default = CODECS[name]
+    if not level:
+        return method, default
+    if method == zipfile.ZIP_STORED:
+        raise ValueError('codec %s takes no level' % name)
+    level = int(level)
+    if not 1 <= level <= 9:
+        raise ValueError('codec level must be 1 to 9, not %d' % level)
+    return method, level
+
+
+def pick_codec(codec, path, size):
+    """Resolve 'auto' to a real codec for a file of the given size"""
+    if codec != 'auto':
+        return codec
+    if os.path.splitext(path)[1].lower() in COMPRESSED_SUFFIXES:
+        return 'store'
+    if size > AUTO_FAST_SIZE:
+        return AUTO_FAST_CODEC
+    return AUTO_BEST_CODEC
+
+
+# Resumable uploads: size of each checksummed piece, how many failed
+# attempts in a row are given up on, and the backoff between attempts
+# (doubling from RESUME_BACKOFF up to RESUME_BACKOFF_MAX seconds, with a
+# random part so many laptops do not retry in step).  A connection that
+# stays silent for RESUME_TIMEOUT seconds counts as a failed attempt.
+RESUME_CHUNK_SIZE = 256 * 1024
+RESUME_RETRIES = 8
+RESUME_BACKOFF = 2
+RESUME_BACKOFF_MAX = 300
+RESUME_TIMEOUT = 60
+
+# Timestamps at the start of a log line, ignored when deciding whether
+# two lines repeat: Sugar's epoch seconds, dmesg's uptime, syslog's and
+# ISO dates.  Lines longer than FOLD_MAX_LINE are passed on unfolded.
+TIMESTAMP_RE = re.compile(r'^\s*(?:\d{9,}(?:\.\d+)?'
+                          r'|\[\s*\d+\.\d+\]'
+                          r'|[A-Z][a-z]{2} [ \d]\d \d\d:\d\d:\d\d'
+                          r'|\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d(?:[.,]\d+)?)\s*')
+# The kernel's uptime after the host and tag of a syslog line, as in
+# 'xo kernel: [   12.345678] ...', once the date is stripped
+UPTIME_RE = re.compile(r'^(\S+ [^\s:]+: )\[\s*\d+\.\d+\]\s*')
+FOLD_MAX_LINE = 65536
+
+
+def fold_repeats(chunks):
+    """Yield chunks of log text with runs of repeated lines folded
+
+    A run of lines that are identical but for their timestamp, and the
+    kernel uptime syslog lines carry after it, becomes its first line, a
+    note saying how many lines were left out, and its last line.  Works
+    line by line, in linear time and constant memory.
+    """
+    out = []
+    out_size = [0]
+
+    def emit(text):
+        out.append(text)
+        out_size[0] += len(text)
+
+    run = [None, None, None, 0]   # key, first, last, count
+
+    def end_run():
+        key, first, last, count = run
+        if count > 0:
+            emit(first)
+        if count > 2:
+            emit('logcollect: %d repeats of the line above folded\n' %
+                 (count - 2))
+        if count > 1:
+            emit(last)
+        run[:] = [None, None, None, 0]
+
+    def add(line):
+        key = UPTIME_RE.sub(r'\1', TIMESTAMP_RE.sub('', line, 1), 1)
+        if run[3] > 0 and key == run[0]:
+            run[2] = line
+            run[3] += 1
+        else:
+            end_run()
+            run[:] = [key, line, None, 1]
+
+    partial = ''
+    for chunk in chunks:
+        lines = (partial + chunk).split('\n')
+        partial = lines.pop()
+        for line in lines:
+            add(line + '\n')
+        if len(partial) > FOLD_MAX_LINE:
+            end_run()
+            emit(partial)
+            partial = ''
+        if out_size[0] >= CHUNK_SIZE:
+            yield ''.join(out)
+            del out[:]
+            out_size[0] = 0
+
+    end_run()
+    emit(partial)
+    data = ''.join(out)
+    if data:
+        yield data
+
+
+def _compressor(method, level):
+    if method == zipfile.ZIP_DEFLATED:
+        return zlib.compressobj(level, zlib.DEFLATED, -15)
+    if method == ZIP_BZIP2:
+        return bz2.BZ2Compressor(level)
+    return None
+
+# Seconds a single shell probe may run, and seconds all probes of one
+# laptop_info() report may take together.
+PROBE_TIMEOUT = 20
+PROBE_DEADLINE = 45
+
+# Seconds a volatile reading (free memory, load, disk usage) is reused
+# before it is taken again.
+READING_TTL = 2
+
+# Where LogCollect remembers how much of each log was already reported,
+# how much already reported context to repeat in incremental mode, and
+# how many bytes before a checkpoint are hashed to recognise the file.
+CHECKPOINT_PATH = os.path.join(os.path.expanduser('~'), '.sugar', 'default',
+                               'onesupport', 'checkpoints.json')
+CHECKPOINT_OVERLAP = 4096
+CHECKPOINT_HASH_BYTES = 4096
+
+# Budget mode: every log first gets a tail of up to BUDGET_MIN_TAIL bytes
+# if it fits, before the rest goes to the logs in order of priority.  The
+# compression ratio of a log is estimated on its last BUDGET_SAMPLE bytes;
+# every member costs about MEMBER_OVERHEAD bytes of headers plus twice
+# its name, and BUDGET_RESERVE is kept for resolv.conf and the notes.
+BUDGET_MIN_TAIL = 16 * 1024
+BUDGET_SAMPLE = 64 * 1024
+BUDGET_RESERVE = 4096
+MEMBER_OVERHEAD = 128
+
+# Facts that cannot change while the system is running, and the latest
+# volatile readings with the time they were taken.  Both are shared by
+# every MachineProperties in the process.
+_facts = {}
+_readings = {}
+
+# clockid_t of CLOCK_MONOTONIC on Linux
+CLOCK_MONOTONIC = 1
+
+
+def _monotonic_clock():
+    """Return a function reading CLOCK_MONOTONIC through libc, or
+    time.time if that is not available"""
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1',
+                            use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+        def read():
+            ts = timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+                return time.time()
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+
+        read()
+        return read
+    except Exception:
+        return time.time
+
+_monotonic = _monotonic_clock()
+
+
+def monotonic():
+    """Seconds since some fixed point, not affected by changes to the
+    system clock (as when NTP or the user set the date).  For timing."""
+    return _monotonic()
+
+
+# ioprio_set() syscall numbers and arguments, see linux/ioprio.h
+IOPRIO_SET = {'i386': 289, 'i686': 289, 'x86_64': 251, 'armv7l': 314}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_SHIFT = 13
+# The lowest best-effort level; the idle class can starve for good on a
+# busy disk, and an unprivileged thread cannot leave it again
+IOPRIO_BE_LOWEST = 7
+
+
+def background_priority():
+    """Lower the CPU and I/O priority of the calling thread to the
+    lowest that still makes progress: nice 19, best-effort I/O level 7
+
+    On Linux both priorities belong to the thread rather than the
+    process, so the other threads keep theirs.  Failures are ignored.
+    """
+    try:
+        os.nice(19)
+    except OSError:
+        pass
+
+    try:
+        import ctypes
+        nr = IOPRIO_SET.get(os.uname()[4])
+        if nr is not None:
+            libc = ctypes.CDLL(None, use_errno=True)
+            libc.syscall(nr, IOPRIO_WHO_PROCESS, 0,
+                         IOPRIO_CLASS_BE << IOPRIO_CLASS_SHIFT |
+                         IOPRIO_BE_LOWEST)
+    except Exception:
+        pass
+
+
+def cached_fact(key, loader):
+    """Return loader(), computing it only once per process"""
+    if key not in _facts:
+        _facts[key] = loader()
+    return _facts[key]
+
+
+def cached_reading(key, loader, ttl=READING_TTL):
+    """Return loader(), reusing the last value for up to ttl seconds"""
+    now = monotonic()
+    if key in _readings:
+        value, taken = _readings[key]
+        if 0 <= now - taken < ttl:
+            return value
+    value = loader()
+    _readings[key] = (value, now)
+    return value
+
+
+def _write_chunks(z, arcname, chunks, size_hint=0, date_time=None,
+                  codec=None):
+    """Add a member to an open ZipFile, compressing it as chunks arrive
+
+    This is what ZipFile.write() does for a path, but for any iterable of
+    strings, so neither a whole log nor its tail is ever held in memory.
+    The member header is rewritten with the real CRC and sizes at the end.
+    If reading the chunks fails halfway, what was written of the member is
+    cut off the archive again and the error raised, so the caller can add
+    a note under the same name.
+
+    Arguments:
+        z           An open, writable zipfile.ZipFile
+        arcname     Name of the member in the archive
+        chunks      Iterable of strings making up the member contents
+        size_hint   Expected uncompressed size, used to decide on zip64
+        date_time   Member timestamp tuple, defaults to now
+        codec       Codec name (see CODECS), defaults to the compression
+                    the archive was opened with
+    """
+    if date_time is None:
+        date_time = time.localtime(time.time())[:6]
+
+    if codec is None:
+        method, level = z.compression, zlib.Z_DEFAULT_COMPRESSION
+    else:
+        method, level = parse_codec(codec)
+
+    zinfo = zipfile.ZipInfo(arcname, date_time)
+    zinfo.external_attr = 0600 << 16L
+    zinfo.compress_type = zipfile.ZIP_STORED
+    zinfo.flag_bits = 0x00
+    zinfo.file_size = size_hint
+    zinfo.header_offset = z.fp.tell()
+    z._writecheck(zinfo)
+    z._didModify = True
+
+    # Set only after the check, zipfile does not know about bzip2
+    zinfo.compress_type = method
+    if method == ZIP_BZIP2:
+        zinfo.extract_version = max(46, zinfo.extract_version)
+        zinfo.create_version = max(46, zinfo.create_version)
+
+    zip64 = z._allowZip64 and size_hint * 1.05 > zipfile.ZIP64_LIMIT
+    zinfo.CRC = crc = 0
+    zinfo.compress_size = compress_size = 0
+    file_size = 0
+    z.fp.write(zinfo.FileHeader(zip64))
+
+    cmpr = _compressor(method, level)
+
+    try:
+        for buf in chunks:
+            file_size += len(buf)
+            crc = zlib.crc32(buf, crc) & 0xffffffff
+            if cmpr:
+                buf = cmpr.compress(buf)
+            compress_size += len(buf)
+            z.fp.write(buf)
+    except:
+        z.fp.seek(zinfo.header_offset, 0)
+        z.fp.truncate()
+        raise
+
+    if cmpr:
+        buf = cmpr.flush()
+        compress_size += len(buf)
+        z.fp.write(buf)
+    zinfo.CRC = crc
+    zinfo.file_size = file_size
+    zinfo.compress_size = compress_size
+
+    # Seek back and write the header again, now with the real values
+    position = z.fp.tell()
+    z.fp.seek(zinfo.header_offset, 0)
+    z.fp.write(zinfo.FileHeader(zip64))
+    z.fp.seek(position, 0)
+    z.filelist.append(zinfo)
+    z.NameToInfo[zinfo.filename] = zinfo
+
+
+class Probe:
+    """A shell command running in the background, collecting its output"""
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.started = time.time()
+        self._output = []
+        self._process = subprocess.Popen(cmd, shell=True,
+                                          stdout=subprocess.PIPE,
+                                          close_fds=True,
+                                          preexec_fn=os.setsid)
+        self._reader = threading.Thread(target=self._read)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _read(self):
+        try:
+            for line in iter(self._process.stdout.readline, ''):
+                self._output.append(line)
+        finally:
+            self._process.stdout.close()
+            self._process.wait()
+
+    def result(self, timeout):
+        """Wait up to timeout seconds and return the output of the command
+
+        A probe that is still running by then is killed, together with
+        anything it started (su, yum...), and a note saying how long it
+        ran is returned instead.
+        """
+        self._reader.join(max(timeout, 0))
+        if self._reader.isAlive():
+            self.kill()
+            return 'timed out after %ds\n' % round(time.time() -
+                                                    self.started)
+        return ''.join(self._output)
+
+    def kill(self):
+        try:
+            os.killpg(self._process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+class ProbeRunner:
+    """Run shell probes concurrently, each with its own time limit
+
+    Every probe gets at most timeout seconds, counted from when it was
+    started, and no probe is waited for past the global deadline.
+    """
+
+    def __init__(self, timeout=PROBE_TIMEOUT, deadline=PROBE_DEADLINE):
+        self._timeout = timeout
+        self._deadline = time.time() + deadline
+        self._probes = {}
+
+    def start(self, cmd):
+        if cmd not in self._probes:
+            self._probes[cmd] = Probe(cmd)
+
+    def __contains__(self, cmd):
+        return cmd in self._probes
+
+    def result(self, cmd):
+        probe = self._probes[cmd]
+        limit = min(probe.started + self._timeout, self._deadline)
+        return probe.result(limit - time.time())
+
+    def stop(self):
+        """Kill whatever is still running"""
+        for probe in self._probes.values():
+            probe.kill()
+        self._probes = {}
+
 
 class MachineProperties:
     """Various machine properties in easy to access chunks.
     """
 
+    IFCONFIG = '/sbin/ifconfig'
+    ROUTE = '/sbin/route -n'
+    DF = '/bin/df -a'
+    PS = '/bin/ps auxfwww'
+    FREE = '/usr/bin/free'
+    TOP = '/usr/bin/top -bn2'
+    YUM_HISTORY = 'su --session-command "/usr/bin/yum history package-list \*"'
+    YUM_VERSION = 'su --session-command "/usr/bin/yum -C version installed -v"'
+    ETHTOOL = 'su --session-command "/usr/sbin/ethtool -i eth0"'
+
+    HARVEST_REPONAME = '/desktop/sugar/collaboration/harvest_reponame'
+
+    # Build the ifconfig, route, df, ps and free reports from /proc and
+    # /sys instead of forking the tools, which stay as a fallback.
+    use_native = True
+
+    _runner = None
+
+    def set_probe_runner(self, runner):
+        """Take the output of already started probes from runner
+
+        Commands that were not started on runner still run on demand.
+        """
+        self._runner = runner
+
+    def probes(self):
+        """Return the shell commands laptop_info() is going to need"""
+        cmds = [self.ETHTOOL, self.YUM_HISTORY, self.TOP]
+        if not self._have_native():
+            cmds += [self.IFCONFIG, self.ROUTE, self.DF, self.PS, self.FREE]
+        if self._harvest_reponame():
+            cmds.append(self.YUM_VERSION)
+        return cmds
+
     def __read_file(self, filename):
         """Read the entire contents of a file and return it as a string"""
 
@@ -102,6 +569,9 @@ class MachineProperties:
         return ''
 
     def loadavg(self):
+        return cached_reading('loadavg', self._loadavg)
+
+    def _loadavg(self):
         for line in self.__read_file('/proc/loadavg').splitlines():
             if line != '':
                 return line            
@@ -114,6 +584,9 @@ class MachineProperties:
         return ''
 
     def memfree(self):
+        return cached_reading('memfree', self._memfree)
+
+    def _memfree(self):
         line = ''
 
         for line in self.__read_file('/proc/meminfo').splitlines():
@@ -122,7 +595,10 @@ class MachineProperties:
 
     def _mfg_data(self, item):
         """Return mfg data item from mfg-data directory"""
+        return cached_fact(('mfg-data', item),
+                           lambda: self._read_mfg_data(item))
 
+    def _read_mfg_data(self, item):
         mfg_path = None
         for test_path in MFG_DATA_PATHS:
             if os.path.exists(test_path + item):
@@ -149,7 +625,7 @@ class MachineProperties:
         if s == '':
             return ''
             
-        return '%02X' % ord(self._mfg_data('SG')[0:1])
+        return '%02X' % ord(s)
         
 
     def laptop_uuid(self):
@@ -200,40 +676,200 @@ class MachineProperties:
         
         return bi
        
+    def _statvfs(self, path):
+        return cached_reading(('statvfs', path), lambda: os.statvfs(path))
+
     def disksize(self, path):
-        return os.statvfs(path).f_bsize * os.statvfs(path).f_blocks
+        st = self._statvfs(path)
+        return st.f_bsize * st.f_blocks
     
     def diskfree(self, path):
-        return os.statvfs(path).f_bsize * os.statvfs(path).f_bavail
+        st = self._statvfs(path)
+        return st.f_bsize * st.f_bavail
         
     def _read_popen(self, cmd):
-        p = os.popen(cmd)
-        s = ''
-        try:
-            for line in p:
-                s += line 
-        finally:
-            p.close()        
-        
-        return s
+        if self._runner is not None and cmd in self._runner:
+            return self._runner.result(cmd)
+        return Probe(cmd).result(PROBE_TIMEOUT)
     
+    def _have_native(self):
+        return self.use_native and os.path.exists('/proc/self/stat')
+
+    def _native_or_popen(self, reader, cmd):
+        """Return reader(), or the output of cmd if that is not possible"""
+        if self._have_native():
+            try:
+                return reader()
+            except (IOError, OSError):
+                pass
+        return self._read_popen(cmd)
+
     def ifconfig(self):        
-        return self._read_popen('/sbin/ifconfig')
+        return self._native_or_popen(self.native_ifconfig, self.IFCONFIG)
                
     def route_n(self):        
-        return self._read_popen('/sbin/route -n')
+        return self._native_or_popen(self.native_route_n, self.ROUTE)
     
     def df_a(self):
-        return self._read_popen('/bin/df -a')
+        return self._native_or_popen(self.native_df_a, self.DF)
   
     def ps_auxfwww(self):
-        return self._read_popen('/bin/ps auxfwww')
+        return self._native_or_popen(self.native_ps, self.PS)
     
     def usr_bin_free(self):
-        return self._read_popen('/usr/bin/free')
+        return self._native_or_popen(self.native_free, self.FREE)
+
+    def _if_address(self, sock, name, request):
+        """Return an IPv4 address of interface name via ioctl, or ''"""
+        try:
+            data = fcntl.ioctl(sock.fileno(), request,
+                               struct.pack('256s', name[:15]))
+            return socket.inet_ntoa(data[20:24])
+        except IOError:
+            return ''
+
+    def native_ifconfig(self):
+        """Interfaces and their counters, from /proc/net/dev and /sys"""
+        SIOCGIFADDR = 0x8915
+        SIOCGIFNETMASK = 0x891b
+
+        s = ''
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for line in self.__read_file('/proc/net/dev').splitlines()[2:]:
+                name, counters = line.split(':', 1)
+                name = name.strip()
+                c = counters.split()
+                sys_path = '/sys/class/net/%s/' % name
+
+                s += '%-10s HWaddr %s  MTU:%s  state %s\n' % (
+                    name,
+                    self.__read_file(sys_path + 'address').strip(),
+                    self.__read_file(sys_path + 'mtu').strip(),
+                    self.__read_file(sys_path + 'operstate').strip())
+                addr = self._if_address(sock, name, SIOCGIFADDR)
+                if addr:
+                    s += '           inet addr:%s  Mask:%s\n' % (
+                        addr, self._if_address(sock, name, SIOCGIFNETMASK))
+                s += '           RX packets:%s errors:%s dropped:%s' \
+                     ' bytes:%s\n' % (c[1], c[2], c[3], c[0])
+                s += '           TX packets:%s errors:%s dropped:%s' \
+                     ' bytes:%s\n\n' % (c[9], c[10], c[11], c[8])
+        finally:
+            sock.close()
+
+        return s
+
+    def native_route_n(self):
+        """The kernel routing table, from /proc/net/route"""
+
+        def ip(hex_address):
+            return socket.inet_ntoa(struct.pack('<L', int(hex_address, 16)))
+
+        s = 'Kernel IP routing table\n'
+        s += '%-15s %-15s %-15s %-5s %-6s %-3s %-6s %s\n' % (
+            'Destination', 'Gateway', 'Genmask', 'Flags', 'Metric', 'Ref',
+            'Use', 'Iface')
+        for line in self.__read_file('/proc/net/route').splitlines()[1:]:
+            f = line.split()
+            if len(f) < 8:
+                continue
+            flags = int(f[3], 16)
+            letters = ''
+            for bit, letter in [(0x1, 'U'), (0x2, 'G'), (0x4, 'H'),
+                                (0x10, 'D'), (0x20, 'M'), (0x200, '!')]:
+                if flags & bit:
+                    letters += letter
+            s += '%-15s %-15s %-15s %-5s %-6s %-3s %-6s %s\n' % (
+                ip(f[1]), ip(f[2]), ip(f[7]), letters, f[6], f[4], f[5], f[0])
+        return s
+
+    def native_df_a(self):
+        """Usage of every mounted filesystem, from /proc/mounts"""
+        s = '%-20s %10s %10s %10s %4s %s\n' % (
+            'Filesystem', '1K-blocks', 'Used', 'Available', 'Use%',
+            'Mounted on')
+        for line in self.__read_file('/proc/mounts').splitlines():
+            f = line.split()
+            if len(f) < 2:
+                continue
+            mount = f[1].replace('\\040', ' ')
+            try:
+                st = os.statvfs(mount)
+            except OSError:
+                continue
+            total = st.f_blocks * st.f_frsize / 1024
+            avail = st.f_bavail * st.f_frsize / 1024
+            used = (st.f_blocks - st.f_bfree) * st.f_frsize / 1024
+            if used + avail > 0:
+                percent = '%d%%' % -(-used * 100 // (used + avail))
+            else:
+                percent = '-'
+            s += '%-20s %10d %10d %10d %4s %s\n' % (
+                f[0], total, used, avail, percent, mount)
+        return s
+
+    def native_ps(self):
+        """Every process, from /proc/[pid]/stat, status and cmdline"""
+        ticks = float(os.sysconf('SC_CLK_TCK'))
+        page_kb = os.sysconf('SC_PAGE_SIZE') / 1024
+
+        s = '%-10s %5s %5s %-4s %8s %8s %8s %s\n' % (
+            'USER', 'PID', 'PPID', 'STAT', 'VSZ', 'RSS', 'TIME', 'COMMAND')
+        pids = [int(d) for d in os.listdir('/proc') if d.isdigit()]
+        for pid in sorted(pids):
+            root = '/proc/%d/' % pid
+            try:
+                stat = self.__read_file(root + 'stat')
+                cmdline = self.__read_file(root + 'cmdline')
+                uid = os.stat(root).st_uid
+            except (IOError, OSError):
+                # The process has exited meanwhile
+                continue
+            if not stat:
+                continue
+
+            # comm is in parentheses and may itself contain spaces
+            comm = stat[stat.find('(') + 1:stat.rfind(')')]
+            f = stat[stat.rfind(')') + 2:].split()
+            try:
+                user = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                user = str(uid)
+            seconds = (int(f[11]) + int(f[12])) / ticks
+            command = cmdline.replace('\0', ' ').strip() or '[%s]' % comm
+
+            s += '%-10s %5d %5s %-4s %8d %8d %5d:%02d %s\n' % (
+                user[:10], pid, f[1], f[0], int(f[20]) / 1024,
+                int(f[21]) * page_kb, seconds // 60, seconds % 60, command)
+        return s
+
+    def native_free(self):
+        """Memory and swap usage in kB, from /proc/meminfo"""
+        info = {}
+        for line in self.__read_file('/proc/meminfo').splitlines():
+            name, sep, value = line.partition(':')
+            if value:
+                info[name] = int(value.split()[0])
+
+        total = info.get('MemTotal', 0)
+        free = info.get('MemFree', 0)
+        buffers = info.get('Buffers', 0)
+        cached = info.get('Cached', 0)
+        swap_total = info.get('SwapTotal', 0)
+        swap_free = info.get('SwapFree', 0)
+
+        s = '%6s %11s %11s %11s %11s %11s %11s\n' % (
+            '', 'total', 'used', 'free', 'shared', 'buffers', 'cached')
+        s += '%-6s %11d %11d %11d %11d %11d %11d\n' % (
+            'Mem:', total, total - free, free, info.get('Shmem', 0),
+            buffers, cached)
+        s += '%-6s %11d %11d %11d\n' % (
+            'Swap:', swap_total, swap_total - swap_free, swap_free)
+        return s
 
     def top(self):
-        return self._read_popen('/usr/bin/top -bn2')
+        return self._read_popen(self.TOP)
         
     def installed_activities(self):        
         s = ''        
@@ -247,27 +883,27 @@ class MachineProperties:
         return s
 
     def installed_packages(self):
-        return self._read_popen('su --session-command "/usr/bin/yum history package-list \*"')
+        return self._read_popen(self.YUM_HISTORY)
 
     def build_information(self):
         return self.__read_file('/boot/olpc_build').strip()
 
-    def packages_snapshot(self):
-        path = '/desktop/sugar/collaboration/harvest_reponame'
-        exp = '@%s(\s*)(\d+):(\w+)'
-        cmd = 'su --session-command "/usr/bin/yum -C version installed -v"'
-
+    def _harvest_reponame(self):
         try:
             client = GConf.Client.get_default()
-            reponame = client.get_string(path)
+            return client.get_string(self.HARVEST_REPONAME)
         except:
-            reponame = ''
+            return ''
 
+    def packages_snapshot(self):
+        exp = '@%s(\s*)(\d+):(\w+)'
+
+        reponame = self._harvest_reponame()
         if not reponame:
             return ''
 
         try:
-            raw = self._read_popen(cmd)
+            raw = self._read_popen(self.YUM_VERSION)
             match = re.search(exp % reponame, raw)
             return match.groups(0)[2]
         except:
@@ -275,24 +911,106 @@ class MachineProperties:
 
     def wireless_firmware(self):
         exp = 'firmware-version: (.*)\n'
-        cmd = 'su --session-command "/usr/sbin/ethtool -i eth0"'
 
         try:
-            raw = self._read_popen(cmd)
+            raw = self._read_popen(self.ETHTOOL)
             match = re.search(exp, raw)
             return match.groups(0)[0]
         except:
             return ''
 
 
+class CheckpointStore:
+    """Remember how much of each log file has already been reported
+
+    Every entry holds the inode, the size, the offset reached and a hash
+    of the bytes just before that offset, so a log that was rotated or
+    rewritten since is noticed and reported from the start again.
+    """
+
+    def __init__(self, path=CHECKPOINT_PATH):
+        self._path = path
+        self._entries = {}
+
+        try:
+            f = open(path)
+            try:
+                self._entries = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            pass
+
+    def _tail_hash(self, f, offset):
+        start = max(0, offset - CHECKPOINT_HASH_BYTES)
+        f.seek(start)
+        return hashlib.sha1(f.read(offset - start)).hexdigest()
+
+    def offset(self, path, f):
+        """Return the offset reporting of path can resume from, or 0
+
+        f is path, already open for reading.
+        """
+        return self.entry_offset(self._entries.get(path), f)
+
+    def entry_offset(self, entry, f):
+        """Return the offset of a checkpoint entry if the open file f is
+        still the file it was taken of, or 0"""
+        if entry is None:
+            return 0
+
+        st = os.fstat(f.fileno())
+        if entry['inode'] != st.st_ino or entry['offset'] > st.st_size:
+            return 0
+        if self._tail_hash(f, entry['offset']) != entry['hash']:
+            return 0
+
+        return entry['offset']
+
+    def checkpoint(self, f, offset):
+        """Return a checkpoint entry for the open file f read up to offset"""
+        st = os.fstat(f.fileno())
+        return {'inode': st.st_ino,
+                'size': st.st_size,
+                'offset': offset,
+                'hash': self._tail_hash(f, offset)}
+
+    def update(self, entries):
+        self._entries.update(entries)
+
+    def save(self):
+        directory = os.path.dirname(self._path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        tmp = self._path + '.tmp'
+        f = open(tmp, 'w')
+        try:
+            json.dump(self._entries, f)
+        finally:
+            f.close()
+        os.rename(tmp, self._path)
+
+
 class LogCollect:
     """Collect XO logfiles and machine metadata for reporting to OLPC
 
     """
     def __init__(self):
         self._mp = MachineProperties()
-
-    def write_logs(self, archive='', logbytes=15360):
+        self._checkpoints = None
+        self._pending = {}
+        # Checkpoints of logs refresh_logs() need not add again although
+        # part of them was left out for the budget, never committed
+        self._covered = {}
+        self._incremental = False
+        self._codec = DEFAULT_CODEC
+        self._fold = False
+        # Timings and sizes of the last write_logs()
+        self.stats = {}
+
+    def write_logs(self, archive='', logbytes=15360, incremental=False,
+                   codec=DEFAULT_CODEC, fold=False, budget=0):
         """Write a zipfile containing the tails of the logfiles and machine info of the XO
         
         Arguments:
@@ -302,6 +1020,23 @@ class LogCollect:
             logbytes -  Maximum number of bytes to read from each log file.
                         0 means complete logfiles, not just the tail
                         -1 means only save machine info, no logs
+
+            incremental - Only include what was appended to each log since
+                        the last committed report, plus a little context.
+                        See commit_checkpoints().
+
+            codec -     How to compress the logs: 'store', 'deflate',
+                        'bzip2', each optionally with a level as in
+                        'deflate:1', or 'auto' to decide per file.
+
+            fold -      Fold runs of repeated log lines into their first
+                        and last line and a count, see fold_repeats().
+
+            budget -    If not 0, the size in bytes the archive should
+                        come close to, instead of logbytes per log.  The
+                        newest Sugar logs and the tails of messages and
+                        dmesg come first, rotated logs only if there is
+                        room.  See logcollect-budget.txt in the archive.
         """
         #This function is crammed with try...except to make sure we get as much
         #data as possible, if anything fails.
@@ -314,8 +1049,19 @@ class LogCollect:
                 archive = '/dev/shm/logs-%s.zip' % self._mp.laptop_serial_number()
             except Exception:
                 pass
+
+        started = monotonic()
+        if self._checkpoints is None:
+            self._checkpoints = CheckpointStore()
+        self._pending = {}
+        self._covered = {}
+        self._incremental = incremental
+        parse_codec(pick_codec(codec, '', 0))
+        self._codec = codec
+        self._fold = fold
             
-        z = zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED)
+        z = zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED,
+                            allowZip64=True)
         
         try:            
             try: 
@@ -323,36 +1069,20 @@ class LogCollect:
             except Exception, e:
                 z.writestr('info.txt',
                            "logcollect: could not add info.txt: %s" % e)
+            info_seconds = monotonic() - started
             
             if logbytes > -1:            
-                # Include some log files from /var/log.
-                for fn in ['dmesg', 'messages', 'cron', 'maillog','rpmpkgs',
-                           'Xorg.0.log', 'spooler']:
-                    try:
-                        if os.access('/var/log/'+fn, os.F_OK):
-                            if logbytes == 0:
-                                z.write('/var/log/'+fn, 'var-log/'+fn)
-                            else:
-                                z.writestr('var-log/'+fn,
-                                           self.file_tail('/var/log/'+fn, logbytes))
-                    except Exception, e:
-                        z.writestr('var-log/'+fn,
-                                   "logcollect: could not add %s: %s" % (fn, e))
-                        
-                # Include all current ones from sugar/logs
-                home = os.path.expanduser('~')
-                for path in glob.glob(os.path.join(home, '.sugar', 'default',
-                                                   'logs', '*.log')):
-                    try:
-                        if os.access(path, os.F_OK):
-                            if logbytes == 0:
-                                z.write(path, 'sugar-logs/'+os.path.basename(path))
-                            else:
-                                z.writestr('sugar-logs/'+os.path.basename(path),
-                                           self.file_tail(path, logbytes))
-                    except Exception, e:
-                        z.writestr('sugar-logs/'+fn,
-                                   "logcollect: could not add %s: %s" % (fn, e))
+                if budget > 0:
+                    self._write_budgeted(z, budget)
+                else:
+                    for path, arcname in self._logs():
+                        try:
+                            if os.access(path, os.F_OK):
+                                self._write_log(z, path, arcname, logbytes)
+                        except Exception, e:
+                            z.writestr(arcname,
+                                       "logcollect: could not add %s: %s" %
+                                       (os.path.basename(path), e))
                 try:                 
                     z.write('/etc/resolv.conf')
                 except Exception, e:
@@ -363,31 +1093,464 @@ class LogCollect:
             print 'While creating zip archive: %s' % e            
         
         z.close()        
+
+        members = z.infolist()
+        self.stats = {'seconds': monotonic() - started,
+                      'info_seconds': info_seconds,
+                      'files': len(members),
+                      'bytes': sum([m.file_size for m in members]),
+                      'compressed': os.path.getsize(archive),
+                      'codec': codec,
+                      'incremental': incremental}
         
         return archive
 
-    def file_tail(self, filename, tailbytes):
-        """Read the tail (end) of the file
+    def _logs(self):
+        """Yield (path, arcname) of every log write_logs() includes"""
+        # Some log files from /var/log.
+        for fn in ['dmesg', 'messages', 'cron', 'maillog','rpmpkgs',
+                   'Xorg.0.log', 'spooler']:
+            yield '/var/log/'+fn, 'var-log/'+fn
+
+        # All current ones from sugar/logs
+        home = os.path.expanduser('~')
+        for path in glob.glob(os.path.join(home, '.sugar', 'default',
+                                           'logs', '*.log')):
+            yield path, 'sugar-logs/'+os.path.basename(path)
+
+    def _rotated_logs(self):
+        """Yield (path, arcname) of the older, rotated logs that budget
+        mode includes if there is room, leaving out compressed ones"""
+        paths = []
+        for fn in ['messages', 'cron', 'maillog', 'spooler']:
+            paths.extend(glob.glob('/var/log/%s-*' % fn))
+            paths.extend(glob.glob('/var/log/%s.[0-9]*' % fn))
+        for path in sorted(paths):
+            if os.path.splitext(path)[1] not in COMPRESSED_SUFFIXES:
+                yield path, 'var-log/'+os.path.basename(path)
+
+        # Sugar keeps the logs of earlier sessions in dated directories
+        logs = os.path.join(os.path.expanduser('~'), '.sugar', 'default',
+                            'logs')
+        for path in sorted(glob.glob(os.path.join(logs, '*', '*.log'))):
+            yield path, 'sugar-logs/'+os.path.relpath(path, logs)
+
+    def _ratio(self, f, start, end, codec):
+        """Estimate the compressed size of bytes start to end of the open
+        file f as a fraction of their size, on a sample of the tail"""
+        method, level = parse_codec(codec)
+        compressor = _compressor(method, level)
+        if compressor is None or end <= start:
+            return 1.0
+
+        chunks = self._read_range(f, max(start, end - BUDGET_SAMPLE), end)
+        if self._fold:
+            chunks = fold_repeats(chunks)
+        size = min(end - start, BUDGET_SAMPLE)
+        packed = sum([len(compressor.compress(chunk)) for chunk in chunks])
+        packed += len(compressor.flush())
+        return max(packed, 1) / float(size)
+
+    def _budget_plan(self):
+        """Return the logs budget mode may include, most important first
+
+        Each is a dict of path, arcname, size (of what would be
+        reported), compression ratio and tier: 0 for the current Sugar
+        logs, messages and dmesg, 1 for the other current logs, 2 for the
+        rotated ones.  Within a tier the newest come first.
+        """
+        logs = [(path, arcname, self._tier(arcname))
+                for path, arcname in self._logs()]
+        for path, arcname in self._rotated_logs():
+            logs.append((path, arcname, 2))
+
+        plan = []
+        for path, arcname, tier in logs:
+            try:
+                f = open(path, 'rb')
+            except IOError:
+                continue
+            try:
+                st = os.fstat(f.fileno())
+                start = 0
+                if self._incremental:
+                    start = max(0, self._checkpoints.offset(path, f) -
+                                CHECKPOINT_OVERLAP)
+                size = st.st_size - start
+                codec = pick_codec(self._codec, path, size)
+                plan.append({'path': path,
+                             'arcname': arcname,
+                             'size': size,
+                             'end': st.st_size,
+                             'ratio': self._ratio(f, start, st.st_size,
+                                                  codec),
+                             'tier': tier,
+                             'mtime': st.st_mtime,
+                             'take': 0})
+            finally:
+                f.close()
+
+        plan.sort(key=lambda item: (item['tier'], -item['mtime']))
+        return plan
+
+    def _tier(self, arcname):
+        """Return the budget tier of a current log, see _budget_plan()"""
+        if arcname.startswith('sugar-logs/') or \
+                arcname in ['var-log/messages', 'var-log/dmesg']:
+            return 0
+        return 1
+
+    def _cost(self, item, take=None):
+        """Estimated bytes in the archive for take bytes of a plan item"""
+        if take is None:
+            take = item['take']
+        if take <= 0:
+            return 0
+        return int(take * item['ratio']) + MEMBER_OVERHEAD + \
+            2 * len(item['arcname'])
+
+    def _fit(self, room, ratio, arcname):
+        """Bytes of a log at ratio that fit in room bytes of archive"""
+        return int((room - MEMBER_OVERHEAD - 2 * len(arcname)) / ratio)
+
+    def _allocate(self, plan, room):
+        """Set how many bytes of each log in plan fit in room bytes"""
+        # First a tail of every current log, then as much as fits of
+        # each log in order, rotated ones included
+        for limit, tiers in [(BUDGET_MIN_TAIL, (0, 1)), (None, (0, 1, 2))]:
+            for item in plan:
+                if item['tier'] not in tiers:
+                    continue
+                want = item['size']
+                if limit is not None:
+                    want = min(want, limit)
+                if want <= item['take']:
+                    continue
+                cost = self._cost(item, want) - self._cost(item)
+                if cost > room:
+                    want = item['take'] + \
+                        int((room - self._cost(item, 1)) / item['ratio'])
+                    if want <= item['take']:
+                        continue
+                    cost = self._cost(item, want) - self._cost(item)
+                item['take'] = want
+                room -= cost
+
+    def _write_budgeted(self, z, budget):
+        """Write the logs into the open archive z so it ends up close to
+        budget bytes, see write_logs()"""
+        plan = self._budget_plan()
+        self._allocate(plan, budget - BUDGET_RESERVE - z.fp.tell())
+
+        notes = ['logcollect: budget of %d bytes' % budget,
+                 '%-40s %12s %12s' % ('log', 'included', 'size')]
+        for i, item in enumerate(plan):
+            # Make up for how far the estimates were off so far, using
+            # the room left over or taking it from this log
+            slack = budget - BUDGET_RESERVE - z.fp.tell() - \
+                sum([self._cost(later) for later in plan[i:]])
+            take = item['take']
+            if slack < 0 or take < item['size']:
+                take += int(slack / item['ratio'])
+                take = max(0, min(item['size'], take))
+            item['take'] = take
+
+            if take > 0:
+                try:
+                    # 0 includes the whole log
+                    self._write_log(z, item['path'], item['arcname'],
+                                    take < item['size'] and take or 0,
+                                    cut=take < item['size'])
+                except Exception, e:
+                    z.writestr(item['arcname'],
+                               "logcollect: could not add %s: %s" %
+                               (os.path.basename(item['path']), e))
+            else:
+                self._skip_log(item['path'], item['end'])
+            notes.append('%-40s %12d %12d' % (item['arcname'], take,
+                                               item['size']))
+
+        z.writestr('logcollect-budget.txt', '\n'.join(notes) + '\n')
+
+    def _skip_log(self, path, end):
+        """Keep refresh_logs() from adding path up to end, which was left
+        out for the budget; the next incremental archive still has it"""
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return
+        try:
+            self._covered[path] = self._checkpoints.checkpoint(f, end)
+        finally:
+            f.close()
+
+    def _reached(self, path, checkpoint, cut=False):
+        """Record that the archive has path up to checkpoint
+
+        If part of it was cut for the budget, now or before, only
+        refresh_logs() goes by it: commit_checkpoints() keeps the last
+        checkpoint up to which the log went in whole.
+        """
+        if cut or path in self._covered:
+            self._covered[path] = checkpoint
+        else:
+            self._pending[path] = checkpoint
+
+    def refresh_logs(self, archive, logbytes=15360, budget=0):
+        """Bring an archive the last write_logs() wrote up to date
+
+        What was appended to a log since is added as a member named like
+        the log plus '.more'.  Logs that were rotated or replaced since
+        are added again as '.new', and logs that did not exist yet are
+        added as write_logs() would.  info.txt is left as it was.
+
+        With a budget, as in write_logs(), what is added is cut down to
+        the newest bytes that keep the archive within it, taking the logs
+        in the order budget mode does.
+
+        Returns the number of members added.
+        """
+        started = monotonic()
+        z = zipfile.ZipFile(archive, 'a', zipfile.ZIP_DEFLATED,
+                            allowZip64=True)
+        names = set(z.namelist())
+        added = 0
+        logs = list(self._logs())
+        if budget > 0:
+            logs.sort(key=lambda log: (self._tier(log[1]),
+                                       -self._mtime(log[0])))
+        try:
+            for path, arcname in logs:
+                room = None
+                if budget > 0:
+                    room = budget - BUDGET_RESERVE - z.fp.tell()
+                try:
+                    if os.access(path, os.F_OK) and \
+                            self._append_log(z, path, arcname, names,
+                                             logbytes, room):
+                        added += 1
+                except Exception, e:
+                    z.writestr(arcname + '.more',
+                               "logcollect: could not add %s: %s" %
+                               (os.path.basename(path), e))
+                    added += 1
+        finally:
+            z.close()
+
+        if self.stats:
+            self.stats['refresh_seconds'] = monotonic() - started
+            self.stats['refresh_files'] = added
+            self.stats['compressed'] = os.path.getsize(archive)
+        return added
+
+    def _mtime(self, path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return 0
+
+    def _append_log(self, z, path, arcname, names, logbytes, room=None):
+        """Add what path gained since the last write_logs() to the open
+        archive z, see refresh_logs().  room, if not None, is how many
+        bytes of archive it may take.  Returns whether anything was."""
+        f = open(path, 'rb')
+        try:
+            end = os.fstat(f.fileno()).st_size
+            entry = self._covered.get(path, self._pending.get(path))
+            start = self._checkpoints.entry_offset(entry, f)
+            cut = False
+
+            if entry is None or start == 0 and entry['offset'] > 0:
+                if arcname in names:
+                    arcname += '.new'
+                if room is not None:
+                    if self._incremental:
+                        start = max(0, self._checkpoints.offset(path, f) -
+                                    CHECKPOINT_OVERLAP)
+                    codec = pick_codec(self._codec, path, end - start)
+                    take = self._fit(room, self._ratio(f, start, end, codec),
+                                     arcname)
+                    if take <= 0:
+                        self._skip_log(path, end)
+                        return False
+                    if take < end - start:
+                        logbytes = take
+                        cut = True
+                self._write_log(z, path, arcname, logbytes, cut)
+                return True
+            if start == end:
+                return False
+
+            if room is not None:
+                codec = pick_codec(self._codec, path, end - start)
+                take = self._fit(room, self._ratio(f, start, end, codec),
+                                 arcname + '.more')
+                if take <= 0:
+                    self._skip_log(path, end)
+                    return False
+                if take < end - start:
+                    start = self._line_start(f, end - take, end)
+                    cut = True
+
+            chunks = self._read_range(
+                f, start, end,
+                'logcollect: appended since the archive was built, '
+                'from byte %d\n' % start)
+            if self._fold:
+                chunks = fold_repeats(chunks)
+            _write_chunks(z, arcname + '.more', chunks,
+                          size_hint=end - start,
+                          codec=pick_codec(self._codec, path, end - start))
+
+            self._reached(path, self._checkpoints.checkpoint(f, end), cut)
+            return True
+        finally:
+            f.close()
+
+    def commit_checkpoints(self):
+        """Remember the logs of the last write_logs() as reported
+
+        Call this once the archive has reached its destination, so the
+        next incremental archive starts where this one ended.
+        """
+        if self._checkpoints is None or not self._pending:
+            return
+        self._checkpoints.update(self._pending)
+        self._checkpoints.save()
+        self._pending = {}
+
+    def _write_log(self, z, path, arcname, logbytes, cut=False):
+        """Stream the tail of a log file into the open archive z; cut
+        tells it the tail was shortened for the budget"""
+        f = open(path, 'rb')
+        try:
+            st = os.fstat(f.fileno())
+            end = st.st_size
+
+            start = self.tail_offset(f, end, logbytes)
+
+            note = ''
+            if self._incremental:
+                offset = self._checkpoints.offset(path, f)
+                if offset - CHECKPOINT_OVERLAP > start:
+                    start = self._line_start(f, offset - CHECKPOINT_OVERLAP,
+                                             end)
+                    note = 'logcollect: continued from byte %d\n' % start
+
+            chunks = self._read_range(f, start, end, note)
+            if self._fold:
+                chunks = fold_repeats(chunks)
+
+            _write_chunks(z, arcname, chunks,
+                          size_hint=end - start,
+                          date_time=time.localtime(st.st_mtime)[:6],
+                          codec=pick_codec(self._codec, path, end - start))
+
+            self._reached(path, self._checkpoints.checkpoint(f, end), cut)
+        finally:
+            f.close()
+
+    def _read_range(self, f, start, end, head='', chunksize=CHUNK_SIZE):
+        """Yield head, then bytes start to end of the open file f"""
+        if head:
+            yield head
+
+        f.seek(start)
+        left = end - start
+        while left > 0:
+            data = f.read(min(chunksize, left))
+            if not data:
+                break
+            left -= len(data)
+            yield data
+
+    def _line_start(self, f, pos, end, blocksize=CHUNK_SIZE):
+        """Return the offset of the first line starting at or after pos
+
+        If no line starts between pos and end, pos itself is returned, so
+        one overlong line is still cut rather than dropped.
+        """
+        if pos <= 0:
+            return 0
+
+        f.seek(pos - 1)
+        offset = pos - 1
+        while offset < end:
+            block = f.read(min(blocksize, end - offset))
+            if not block:
+                break
+            i = block.find('\n')
+            if i > -1:
+                return offset + i + 1
+            offset += len(block)
+
+        return pos
+
+    def tail_offset(self, f, end, tailbytes=0, lines=0, blocksize=CHUNK_SIZE):
+        """Return where the tail of the open file f starts, on a line boundary
+
+        The tail is at most tailbytes long and at most lines lines long,
+        0 meaning no limit.  Lines are counted reading backwards from end
+        in blocks, so only the tail itself is ever read.
+        """
+        start = 0
+        if tailbytes > 0 and end > tailbytes:
+            start = self._line_start(f, end - tailbytes, end, blocksize)
+
+        if lines > 0:
+            # A newline right at the end does not start another line
+            f.seek(max(end - 1, 0))
+            offset = end
+            if end > 0 and f.read(1) == '\n':
+                offset = end - 1
+
+            found = 0
+            while offset > start:
+                size = min(blocksize, offset - start)
+                offset -= size
+                f.seek(offset)
+                block = f.read(size)
+                i = len(block)
+                while True:
+                    i = block.rfind('\n', 0, i)
+                    if i < 0:
+                        break
+                    found += 1
+                    if found == lines:
+                        return max(start, offset + i + 1)
+
+        return start
+
+    def file_chunks(self, filename, tailbytes, chunksize=CHUNK_SIZE, lines=0):
+        """Yield the tail (end) of the file in pieces of chunksize bytes
+
+        The tail always starts at the beginning of a line.
         
         Arguments:
             filename    The name of the file to read
             tailbytes   Number of bytes to include or 0 for entire file
+            chunksize   Maximum size of each piece
+            lines       Number of lines to include or 0 for no limit
         """
 
-        data = ''
-
-        f = open(filename)
+        f = open(filename, 'rb')
         try:
-            fsize = os.stat(filename).st_size
-            
-            if tailbytes > 0 and fsize > tailbytes:
-                f.seek(-tailbytes, 2)
-                
-            data = f.read()
+            end = os.fstat(f.fileno()).st_size
+            start = self.tail_offset(f, end, tailbytes, lines, chunksize)
+            for data in self._read_range(f, start, end, chunksize=chunksize):
+                yield data
         finally:
             f.close()
 
-        return data        
+    def file_tail(self, filename, tailbytes):
+        """Read the tail (end) of the file
+        
+        Arguments:
+            filename    The name of the file to read
+            tailbytes   Number of bytes to include or 0 for entire file
+        """
+
+        return ''.join(self.file_chunks(filename, tailbytes))
               
 
     def make_report(self, target='stdout'):
@@ -407,6 +1570,13 @@ class LogCollect:
     def laptop_info(self):
         """Return a string with laptop serial, battery type, build, memory info, etc."""
 
+        # Start all the slow shell probes at once, the report below then
+        # just picks up their output (or a timeout note) in order.
+        runner = ProbeRunner()
+        for cmd in self._mp.probes():
+            runner.start(cmd)
+        self._mp.set_probe_runner(runner)
+
         s = ''        
         try:
             # Do not include UUID!
@@ -446,10 +1616,135 @@ class LogCollect:
             s += '\n[top -bn2]\n%s\n' % self._mp.top()
         except Exception, e:
             s += '\nException while building info:\n%s\n' % e
+        finally:
+            self._mp.set_probe_runner(None)
+            runner.stop()
         
         return s
 
+class MultipartBody:
+    """A multipart/form-data body that is sent straight from disk
+
+    Files are added by path (optionally just a byte range of them) and
+    only read, in CHUNK_SIZE pieces, while the body is being sent.  The
+    total length is known up front from the file sizes.
+    """
+
+    BOUNDARY = '----------ThIs_Is_tHe_bouNdaRY_$'
+    CRLF = '\r\n'
+
+    def __init__(self):
+        # Strings, or (path, start, length) ranges to be read later
+        self._parts = []
+
+    def add_field(self, name, value):
+        self._parts.append(self.CRLF.join([
+            '--' + self.BOUNDARY,
+            'Content-Disposition: form-data; name="%s"' % name,
+            '', value, '']))
+
+    def _add_file_header(self, name, filename, content_type):
+        self._parts.append(self.CRLF.join([
+            '--' + self.BOUNDARY,
+            'Content-Disposition: form-data; name="%s"; filename="%s"' %
+            (name, filename),
+            'Content-Type: %s' % content_type,
+            '', '']))
+
+    def add_file(self, name, filename, content_type, path, start=0,
+                 length=None):
+        """Add length bytes of path from start, by default all of it"""
+        if length is None:
+            length = os.path.getsize(path) - start
+        self._add_file_header(name, filename, content_type)
+        self._parts.append((path, start, length))
+        self._parts.append(self.CRLF)
+
+    def add_file_data(self, name, filename, content_type, value):
+        self._add_file_header(name, filename, content_type)
+        self._parts.append(value + self.CRLF)
+
+    def content_type(self):
+        return 'multipart/form-data; boundary=%s' % self.BOUNDARY
+
+    def _closing(self):
+        return '--' + self.BOUNDARY + '--' + self.CRLF
+
+    def __len__(self):
+        size = len(self._closing())
+        for part in self._parts:
+            if isinstance(part, tuple):
+                size += part[2]
+            else:
+                size += len(part)
+        return size
+
+    def chunks(self):
+        for part in self._parts:
+            if not isinstance(part, tuple):
+                yield part
+                continue
+
+            path, start, length = part
+            f = open(path, 'rb')
+            try:
+                f.seek(start)
+                while length > 0:
+                    data = f.read(min(CHUNK_SIZE, length))
+                    if not data:
+                        raise IOError('%s is shorter than expected' % path)
+                    length -= len(data)
+                    yield data
+            finally:
+                f.close()
+
+        yield self._closing()
+
+
 class LogSend:
+
+    def __init__(self):
+        self._connections = {}
+
+    def _connection(self, scheme, host):
+        """Return the kept-alive connection to host, opening it if needed"""
+        key = (scheme, host)
+        if key not in self._connections:
+            if scheme == 'https':
+                self._connections[key] = httplib.HTTPSConnection(
+                    host, timeout=RESUME_TIMEOUT)
+            else:
+                self._connections[key] = httplib.HTTPConnection(
+                    host, timeout=RESUME_TIMEOUT)
+        return self._connections[key]
+
+    def close(self):
+        for connection in self._connections.values():
+            connection.close()
+        self._connections = {}
+
+    def post_body(self, host, selector, body, scheme='http'):
+        """POST a MultipartBody to host and return the server's response page
+
+        The connection is kept open for the next request.  If the server
+        dropped it while it was idle, the request is sent once more on a
+        fresh one.
+        """
+        for attempt in range(2):
+            connection = self._connection(scheme, host)
+            reused = connection.sock is not None
+            try:
+                connection.putrequest('POST', selector)
+                connection.putheader('Content-Type', body.content_type())
+                connection.putheader('Content-Length', str(len(body)))
+                connection.endheaders()
+                for chunk in body.chunks():
+                    connection.send(chunk)
+                return connection.getresponse().read()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if not reused or attempt > 0:
+                    raise
     
     # post_multipart and encode_multipart_formdata have been taken from
     #  http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/146306
@@ -460,16 +1755,13 @@ class LogSend:
         files is a sequence of (name, filename, value) elements for data to be uploaded as files
         Return the server's response page.        
         """
-        content_type, body = self.encode_multipart_formdata(fields, files)
-        h = httplib.HTTP(host)
-        h.putrequest('POST', selector)
-        h.putheader('content-type', content_type)
-        h.putheader('content-length', str(len(body)))
-        h.putheader('Host', host)
-        h.endheaders()
-        h.send(body)
-        errcode, errmsg, headers = h.getreply()
-        return h.file.read()
+        body = MultipartBody()
+        for (key, value) in fields:
+            body.add_field(key, value)
+        for (key, filename, value) in files:
+            body.add_file_data(key, filename, self.get_content_type(filename),
+                               value)
+        return self.post_body(host, selector, body)
     
     def encode_multipart_formdata(self, fields, files):
         """
@@ -514,17 +1806,110 @@ class LogSend:
         return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
         
     def http_post_logs(self, url, archive):
-        #host, selector, fields, files
-        files = ('logs', os.path.basename(archive), self.read_file(archive)),
-        
+        body = MultipartBody()
         # Client= olpc will make the server return just "OK" or "FAIL"
-        fields = ('client', 'xo'),
+        body.add_field('client', 'xo')
+        body.add_file('logs', os.path.basename(archive),
+                      self.get_content_type(archive), archive)
+
         urlparts = urlparse.urlsplit(url)
         print "Sending logs to %s" % url
-        r = self.post_multipart(urlparts[1], urlparts[2], fields, files)
+        r = self.post_body(urlparts[1], urlparts[2], body, urlparts[0])
         print r
         return (r == 'OK')
 
+    def _file_sha1(self, path):
+        digest = hashlib.sha1()
+        f = open(path, 'rb')
+        try:
+            for data in iter(lambda: f.read(CHUNK_SIZE), ''):
+                digest.update(data)
+        finally:
+            f.close()
+        return digest.hexdigest()
+
+    def _backoff(self, failures):
+        """Sleep before attempt number failures + 1, with full jitter"""
+        delay = min(RESUME_BACKOFF_MAX, RESUME_BACKOFF * 2 ** failures)
+        time.sleep(random.uniform(0, delay))
+
+    def resumable_post_logs(self, url, archive, chunksize=RESUME_CHUNK_SIZE,
+                            retries=RESUME_RETRIES):
+        """Send archive in checksummed pieces, resuming after failures
+
+        Every request carries the fields client=xo, upload (SHA-1 of the
+        whole archive), total (its size) and offset.  A request without a
+        file asks where to resume; one with a piece of the archive also
+        carries the piece's SHA-1 as checksum.  The server answers
+        'OK <offset>' with the number of bytes it holds, 'DONE' once it
+        has the whole archive and verified it, or 'FAIL <reason>'.
+
+        Connection errors and FAIL answers are retried with exponential
+        backoff, giving up after retries failures in a row.  Returns True
+        only once the server said DONE.
+        """
+        urlparts = urlparse.urlsplit(url)
+        total = os.path.getsize(archive)
+        upload = self._file_sha1(archive)
+        filename = os.path.basename(archive)
+        offset = None
+        failures = 0
+
+        print "Sending logs to %s in pieces of %d bytes" % (url, chunksize)
+        while True:
+            body = MultipartBody()
+            body.add_field('client', 'xo')
+            body.add_field('upload', upload)
+            body.add_field('total', str(total))
+            if offset is None:
+                body.add_field('offset', '0')
+            else:
+                length = min(chunksize, total - offset)
+                body.add_field('offset', str(offset))
+                f = open(archive, 'rb')
+                try:
+                    f.seek(offset)
+                    checksum = hashlib.sha1(f.read(length)).hexdigest()
+                finally:
+                    f.close()
+                body.add_field('checksum', checksum)
+                body.add_file('logs', filename,
+                              self.get_content_type(archive), archive,
+                              offset, length)
+
+            try:
+                r = self.post_body(urlparts[1], urlparts[2], body,
+                                   urlparts[0]).strip()
+            except (httplib.HTTPException, socket.error), e:
+                r = 'FAIL %s' % e
+
+            if r == 'DONE':
+                print "Server confirmed all %d bytes" % total
+                return True
+
+            if r.startswith('OK '):
+                try:
+                    held = int(r[3:])
+                except ValueError:
+                    held = -1
+                if not 0 <= held < total:
+                    r = 'FAIL unexpected answer %s' % r
+                elif offset is None or held > offset:
+                    if offset is not None:
+                        failures = 0
+                    offset = held
+                    continue
+                else:
+                    r = 'FAIL piece at %d was not taken' % offset
+
+            failures += 1
+            print "%s (attempt %d of %d)" % (r, failures, retries)
+            if failures >= retries:
+                return False
+            self.close()
+            self._backoff(failures)
+            offset = None
+
 
 # This script is dual-mode, it can be used as a command line tool and as
 # a library. 
@@ -557,18 +1942,53 @@ Usage:
     logcollect.py none file
                         - Just save info.txt in /dev/shm/logs-SN123.zip
 
+    logcollect.py incremental http://server.name/submit.php
+                        - Only send what was logged since the last time
+                          logs were sent successfully.
+
+    logcollect.py fold http://server.name/submit.php
+                        - Fold repeated log lines into one with a count.
+
+    logcollect.py resume http://server.name/submit.php
+                        - Send the logs in checksummed pieces, retrying
+                          and resuming where the connection dropped.
+
+    logcollect.py codec=bzip2:9 file:/media/xxxx-yyyy/mylog.zip
+                        - Compress the logs with another codec: store,
+                          deflate, bzip2 (optionally :1 to :9) or auto.
+
+    logcollect.py budget=2097152 http://server.name/submit.php
+                        - Fit the archive into about that many bytes,
+                          the newest and most important logs first.
+
     If you specify 'all' or 'none' you must specify http or file as well.
         """
         sys.exit()
         
     
     logbytes = 15360   
+    incremental = False
+    codec = DEFAULT_CODEC
+    fold = False
+    resume = False
+    budget = 0
     if len(sys.argv)>1:
         mode = sys.argv[len(sys.argv)-1]
         if sys.argv[1] == 'all':
             logbytes = 0
         if sys.argv[1] == 'none':
             logbytes = -1
+        if 'incremental' in sys.argv[1:-1]:
+            incremental = True
+        if 'fold' in sys.argv[1:-1]:
+            fold = True
+        if 'resume' in sys.argv[1:-1]:
+            resume = True
+        for arg in sys.argv[1:-1]:
+            if arg.startswith('codec='):
+                codec = arg[6:]
+            if arg.startswith('budget='):
+                budget = int(arg[7:])
    
 
     if mode.startswith('file'):
@@ -582,7 +2002,7 @@ Usage:
     #else if mode.lower().startswith('sd'):
     #    pass
     
-    logs = lc.write_logs(logs, logbytes)
+    logs = lc.write_logs(logs, logbytes, incremental, codec, fold, budget)
     print 'Logs saved in %s' % logs
     
     sent_ok = False
@@ -597,9 +2017,15 @@ Usage:
         else:
             url = mode
             
-        if ls.http_post_logs(url, logs):
+        if resume:
+            sent = ls.resumable_post_logs(url, logs)
+        else:
+            sent = ls.http_post_logs(url, logs)
+
+        if sent:
             print "Logs were sent."
             sent_ok = True            
+            lc.commit_checkpoints()
         else:
             print "FAILED to send logs."
  
@@ -0,0 +1,145 @@
+# Copyright (c) 2014 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+"""Timings of sending reports, kept locally and attached to the ticket
+
+Usage:
+    python -m backend.metrics [count]
+                        - show the phases of the last count reports
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+from backend.logcollect import monotonic
+
+# One JSON record per line, for every report sent or attempted
+METRICS_PATH = os.path.join(os.path.expanduser('~'), '.sugar', 'default',
+                            'onesupport', 'metrics.json')
+
+# The file is cut down to its last METRICS_KEEP records when it grows
+# past twice that
+METRICS_KEEP = 200
+
+
+class Metrics(object):
+    """
+    Timings and sizes of sending one report: seconds per phase, the
+    archive LogCollect built, and every request made with its status,
+    bytes/s and restarts.  Safe to use from several upload threads.
+    """
+
+    def __init__(self, key=None):
+        self._lock = threading.Lock()
+        self._started = monotonic()
+        self.record = {'key': key,
+                       'date': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                             time.gmtime()),
+                       'phases': {},
+                       'requests': []}
+
+    @contextmanager
+    def phase(self, name):
+        """Time the with block as phase name, even if it raises"""
+        started = monotonic()
+        try:
+            yield
+        finally:
+            self.set_phase(name, monotonic() - started)
+
+    def set_phase(self, name, seconds):
+        with self._lock:
+            self.record['phases'][name] = round(seconds, 3)
+
+    def set(self, name, value):
+        with self._lock:
+            self.record[name] = value
+
+    def request(self, stats, **extra):
+        """Add the stats of a Request, or of an upload that was skipped"""
+        stats = dict(stats or {}, **extra)
+        if stats.get('seconds'):
+            stats['bytes_per_second'] = int(stats.get('bytes', 0) /
+                                            stats['seconds'])
+        with self._lock:
+            self.record['requests'].append(stats)
+
+    def dumps(self):
+        with self._lock:
+            record = dict(self.record)
+        record['seconds'] = round(monotonic() - self._started, 3)
+        return json.dumps(record, sort_keys=True)
+
+    def save(self, path=METRICS_PATH):
+        """Append the record to the metrics file"""
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(path, 'a') as f:
+            f.write(self.dumps() + '\n')
+        _trim(path)
+
+
+def _trim(path, keep=METRICS_KEEP):
+    with open(path) as f:
+        lines = f.readlines()
+    if len(lines) <= 2 * keep:
+        return
+    with open(path + '.tmp', 'w') as f:
+        f.writelines(lines[-keep:])
+    os.rename(path + '.tmp', path)
+
+
+def load(path=METRICS_PATH):
+    """Return the saved records, oldest first"""
+    records = []
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    pass
+    except IOError:
+        pass
+    return records
+
+
+def main(argv):
+    count = 10
+    if len(argv) > 1:
+        try:
+            count = int(argv[1])
+        except ValueError:
+            print __doc__
+            return 1
+
+    for record in load()[-count:]:
+        phases = ', '.join(['%s %.1fs' % (name, seconds) for name, seconds
+                            in sorted(record['phases'].items())])
+        print '%s  %s  %.1fs  %s' % (record['date'], record.get('result'),
+                                     record.get('seconds', 0), phases)
+        for stats in record['requests']:
+            print '    %-6s %-28s %5s %10d B %10s B/s  restarts: %s' % (
+                stats.get('method', ''), stats.get('name',
+                                                   stats.get('path', '')),
+                stats.get('status', 'cached'), stats.get('bytes', 0),
+                stats.get('bytes_per_second', '-'),
+                stats.get('restarts', 0))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
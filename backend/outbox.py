@@ -0,0 +1,330 @@
+# Copyright (c) 2014 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+"""Reports that could not be sent, kept on disk until they can be
+
+Usage:
+    python -m backend.outbox list
+                        - show the reports waiting to be sent
+    python -m backend.outbox flush
+                        - try to send all of them now
+    python -m backend.outbox remove ID
+                        - drop a report without sending it
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import logging
+import threading
+
+from backend.zendesk import NetworkError, ServerError
+
+OUTBOX_PATH = os.path.join(os.path.expanduser('~'), '.sugar', 'default',
+                           'onesupport', 'outbox')
+
+# Seconds before the first retry of a report, doubling with each failed
+# attempt up to OUTBOX_BACKOFF_MAX.  Reports that failed
+# OUTBOX_MAX_ATTEMPTS times are only sent again by an explicit flush.
+OUTBOX_BACKOFF = 60
+OUTBOX_BACKOFF_MAX = 6 * 60 * 60
+OUTBOX_MAX_ATTEMPTS = 20
+
+REPORT = 'report.json'
+
+
+def _sooner(due, other):
+    if due is None:
+        return other
+    if other is None:
+        return due
+    return min(due, other)
+
+
+class Outbox(object):
+    """
+    A directory of spooled reports, one subdirectory each, holding
+    report.json (the send_report data plus delivery state) and copies of
+    every file to attach, logs.zip included.
+    """
+
+    def __init__(self, path=OUTBOX_PATH):
+        self._path = path
+
+    def spool(self, data):
+        """Store a copy of data and its files, return the report id"""
+        if not os.path.exists(self._path):
+            os.makedirs(self._path)
+
+        report_id = '%d-%s' % (time.time(), uuid.uuid4().hex[:8])
+        tmp = os.path.join(self._path, '.' + report_id)
+        os.makedirs(tmp)
+
+        report = dict(data)
+        report['files'] = []
+        for index, file in enumerate(data['files']):
+            name = '%d-%s' % (index, os.path.basename(file['path']))
+            shutil.copyfile(file['path'], os.path.join(tmp, name))
+            spooled = dict(file)
+            spooled['path'] = name
+            report['files'].append(spooled)
+        report['attempts'] = 0
+        report['next_attempt'] = time.time()
+        report['error'] = None
+
+        self._write(tmp, report)
+        # Only a complete report ever shows up under its real name
+        os.rename(tmp, os.path.join(self._path, report_id))
+        return report_id
+
+    def _write(self, directory, report):
+        path = os.path.join(directory, REPORT)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(report, f)
+        os.rename(path + '.tmp', path)
+
+    def ids(self):
+        if not os.path.exists(self._path):
+            return []
+        return sorted([name for name in os.listdir(self._path)
+                       if not name.startswith('.') and
+                       os.path.exists(os.path.join(self._path, name,
+                                                   REPORT))])
+
+    def load(self, report_id):
+        """Return the report, with absolute paths to its files"""
+        directory = os.path.join(self._path, report_id)
+        with open(os.path.join(directory, REPORT)) as f:
+            report = json.load(f)
+        for file in report['files']:
+            file['path'] = os.path.join(directory, file['path'])
+        return report
+
+    def remove(self, report_id):
+        shutil.rmtree(os.path.join(self._path, report_id),
+                      ignore_errors=True)
+
+    def keep_job(self, report_id, job):
+        """Store the batch job the ticket of a report was handed to, or
+        None once that is settled"""
+        directory = os.path.join(self._path, report_id)
+        with open(os.path.join(directory, REPORT)) as f:
+            report = json.load(f)
+        report['job'] = job
+        self._write(directory, report)
+
+    def _failed(self, report_id, error):
+        directory = os.path.join(self._path, report_id)
+        with open(os.path.join(directory, REPORT)) as f:
+            report = json.load(f)
+        report['attempts'] += 1
+        report['error'] = str(error)
+        delay = min(OUTBOX_BACKOFF_MAX,
+                    OUTBOX_BACKOFF * 2 ** (report['attempts'] - 1))
+        report['next_attempt'] = time.time() + random.uniform(0.5, 1) * delay
+        self._write(directory, report)
+
+    def flush(self, deliver, force=False):
+        """
+        Try to deliver every report that is due, or all of them if force.
+
+        deliver: function taking a report, raising NetworkError or
+                 ServerError if it could not be sent
+
+        Returns the number of seconds until the next report is due, or
+        None if none is left that will be retried on its own.
+        """
+        due, next_due = self._due(force)
+        for report_id in due:
+            if self.send(report_id, deliver) is not None:
+                next_due = _sooner(next_due, self._retry_in(report_id))
+        return next_due
+
+    def flush_many(self, deliver_many, force=False):
+        """
+        As flush(), but hand every due report to deliver_many at once,
+        so their tickets can be created in batches.
+
+        deliver_many: function taking a list of reports and a keep_job
+                      function, as reporter.deliver_reports does, and
+                      returning one entry per report: None if it was
+                      sent, else the NetworkError or ServerError it
+                      failed with.  The jobs it keeps are stored with
+                      the reports, so the next flush follows them.
+        """
+        due, next_due = self._due(force)
+        if not due:
+            return next_due
+
+        def keep_job(index, job):
+            self.keep_job(due[index], job)
+
+        errors = deliver_many([self.load(report_id) for report_id in due],
+                              keep_job)
+        for report_id, error in zip(due, errors):
+            if error is None:
+                logging.debug('outbox: %s sent', report_id)
+                self.remove(report_id)
+                continue
+            logging.error('outbox: %s not sent: %s', report_id, error)
+            self._failed(report_id, error)
+            next_due = _sooner(next_due, self._retry_in(report_id))
+        return next_due
+
+    def _due(self, force):
+        """Return the ids of the reports to try now, and the seconds
+        until the next of the others is due, or None"""
+        due = []
+        next_due = None
+        for report_id in self.ids():
+            report = self.load(report_id)
+            if not force:
+                if report['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+                    continue
+                if report['next_attempt'] > time.time():
+                    next_due = _sooner(next_due,
+                                       report['next_attempt'] - time.time())
+                    continue
+            due.append(report_id)
+        return due, next_due
+
+    def _retry_in(self, report_id):
+        """Seconds until a report that just failed is due, None if it
+        will not be retried on its own"""
+        report = self.load(report_id)
+        if report['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+            return None
+        return max(0, report['next_attempt'] - time.time())
+
+    def send(self, report_id, deliver):
+        """
+        Try to deliver one report now, and remove it if that worked.
+
+        Returns None if it was sent, else the NetworkError or ServerError
+        it failed with, which is recorded for the next attempt.
+        """
+        try:
+            deliver(self.load(report_id))
+        except (NetworkError, ServerError) as error:
+            logging.error('outbox: %s not sent: %s', report_id, error)
+            self._failed(report_id, error)
+            return error
+
+        logging.debug('outbox: %s sent', report_id)
+        self.remove(report_id)
+        return None
+
+
+class OutboxSender(object):
+    """
+    Drains an Outbox from a background thread, waiting between attempts
+    as the reports ask, and trying again right away when NetworkManager
+    reports a new connection.  With deliver_many, the reports due are
+    delivered together, see Outbox.flush_many().
+    """
+
+    # NetworkManager states meaning "connected", old and new numbering
+    NM_CONNECTED = [3, 70]
+
+    def __init__(self, outbox, deliver, deliver_many=None):
+        self._outbox = outbox
+        self._deliver = deliver
+        self._deliver_many = deliver_many
+        self._wake = threading.Event()
+        self._stopped = False
+        self._force = False
+        self._thread = None
+
+    def start(self):
+        self._watch_network()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wake(self):
+        """Look at the outbox again now, e.g. after spooling a report"""
+        self._wake.set()
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+
+    def _watch_network(self):
+        try:
+            import dbus
+            bus = dbus.SystemBus()
+            bus.add_signal_receiver(self.__state_changed_cb, 'StateChanged',
+                                    'org.freedesktop.NetworkManager')
+        except Exception as error:
+            logging.debug('outbox: not watching the network: %s', error)
+
+    def __state_changed_cb(self, state):
+        if state in self.NM_CONNECTED:
+            self.flush_now()
+
+    def flush_now(self):
+        """Retry every waiting report now, not after its backoff"""
+        self._force = True
+        self._wake.set()
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.clear()
+            force, self._force = self._force, False
+            try:
+                if self._deliver_many is not None:
+                    delay = self._outbox.flush_many(self._deliver_many,
+                                                    force)
+                else:
+                    delay = self._outbox.flush(self._deliver, force)
+            except Exception as error:
+                logging.error('outbox: flush failed: %s', error)
+                delay = OUTBOX_BACKOFF
+            self._wake.wait(delay)
+
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in ['list', 'flush', 'remove']:
+        print __doc__
+        return 1
+
+    outbox = Outbox()
+
+    if argv[1] == 'list':
+        for report_id in outbox.ids():
+            report = outbox.load(report_id)
+            print '%s  %s  attempts: %d  next: %s  %s' % (
+                report_id, report['subject'], report['attempts'],
+                time.strftime('%Y-%m-%d %H:%M',
+                              time.localtime(report['next_attempt'])),
+                report['error'] or '')
+        return 0
+
+    if argv[1] == 'remove':
+        if len(argv) < 3 or argv[2] not in outbox.ids():
+            print 'No such report'
+            return 1
+        outbox.remove(argv[2])
+        return 0
+
+    from reporter import deliver_reports
+    outbox.flush_many(deliver_reports, force=True)
+    left = outbox.ids()
+    print '%d report(s) still waiting' % len(left)
+    return len(left) > 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
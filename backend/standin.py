@@ -0,0 +1,444 @@
+# Copyright (c) 2014 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+"""Local stand-in servers for trying out and measuring uploads
+
+Usage:
+    python -m backend.standin logs [options]
+                        - receive logcollect.py uploads, both the single
+                          request ones and resumable ones
+    python -m backend.standin zendesk [options]
+                        - answer /api/v2/uploads.json,
+                          /api/v2/tickets.json,
+                          /api/v2/tickets/create_many.json and
+                          /api/v2/job_statuses/ID.json like Zendesk does
+
+Options for both:
+    --port N            port to listen on
+    --drop P            drop a fraction P of the connections at a random
+                        point of the request body
+    --latency S         wait S seconds before answering
+    --bandwidth B       read request bodies at no more than B bytes/s
+    --errors P          answer a fraction P of the requests with
+    --status CODE       this status code instead (default 503)
+    --dir PATH          where to store what was received
+
+Options for zendesk:
+    --item-errors P     fail a fraction P of the tickets of create_many
+    --job-delay S       run create_many jobs S seconds (default 0.2)
+                        after they were queued
+"""
+
+import os
+import cgi
+import sys
+import json
+import time
+import uuid
+import socket
+import random
+import hashlib
+import argparse
+import threading
+import BaseHTTPServer
+import SocketServer
+from StringIO import StringIO
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Keep-alive handler that can drop requests before answering them"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        # One handler per connection, so this counts the handshakes
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format,
+                                                               *args)
+
+    def _read_body(self, keep=True):
+        """Return the request body, or None if the connection was dropped
+
+        The body is read no faster than the server's bandwidth allows,
+        and once it is read the server's latency is waited out.  Without
+        keep only (sha1 hexdigest, size) of the body is returned, and the
+        body is never held in memory whole.
+        """
+        length = int(self.headers.getheader('Content-Length') or 0)
+
+        if random.random() < self.server.drop:
+            # Hang up somewhere in the middle of the body
+            for data in self._chunks(random.randint(0, length)):
+                pass
+            self.server.dropped += 1
+            self.close_connection = 1
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return None
+
+        if keep:
+            body = self._read(length)
+        else:
+            digest = hashlib.sha1()
+            size = 0
+            for data in self._chunks(length):
+                digest.update(data)
+                size += len(data)
+            body = (digest.hexdigest(), size)
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.requests += 1
+        return body
+
+    def _read(self, length):
+        if not self.server.bandwidth:
+            return self.rfile.read(length)
+        return ''.join(self._chunks(length))
+
+    def _chunks(self, length):
+        """Yield the next length bytes of the request a piece at a time"""
+        while length > 0:
+            started = time.time()
+            data = self.rfile.read(min(length, 16384))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+            if self.server.bandwidth:
+                time.sleep(max(0, len(data) / float(self.server.bandwidth) -
+                               (time.time() - started)))
+
+    def _inject_error(self):
+        """Answer with the server's error status instead, sometimes"""
+        if random.random() < self.server.errors:
+            self._reply(self.server.status,
+                        json.dumps({'error': 'injected by the stand-in'}),
+                        'application/json')
+            return True
+        return False
+
+    def _form(self, body):
+        return cgi.FieldStorage(
+            fp=StringIO(body), headers=self.headers,
+            environ={'REQUEST_METHOD': 'POST',
+                     'CONTENT_TYPE': self.headers.getheader('Content-Type')})
+
+    def _reply(self, code, text, content_type='text/plain'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+
+class LogReceiver(StandInHandler):
+    """Accepts what LogSend.http_post_logs and resumable_post_logs send"""
+
+    def do_POST(self):
+        body = self._read_body()
+        if body is None:
+            return
+
+        form = self._form(body)
+        if 'upload' not in form:
+            self._store(os.path.basename(form['logs'].filename),
+                        form['logs'].value)
+            self._reply(200, 'OK')
+            return
+
+        upload = form.getfirst('upload')
+        total = int(form.getfirst('total'))
+        offset = int(form.getfirst('offset'))
+        path = os.path.join(self.server.directory, upload + '.part')
+
+        with self.server.lock:
+            held = 0
+            if os.path.exists(path):
+                held = os.path.getsize(path)
+
+            if 'logs' in form and offset == held:
+                data = form['logs'].value
+                if hashlib.sha1(data).hexdigest() != \
+                        form.getfirst('checksum'):
+                    self._reply(200, 'FAIL checksum mismatch')
+                    return
+                with open(path, 'ab') as f:
+                    f.write(data)
+                held += len(data)
+
+            if held < total:
+                self._reply(200, 'OK %d' % held)
+                return
+
+            with open(path, 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+            if held != total or digest != upload:
+                os.remove(path)
+                self._reply(200, 'FAIL archive does not match, resend')
+                return
+
+            os.rename(path, os.path.join(self.server.directory,
+                                         upload + '.zip'))
+            self.server.received.append(upload)
+            self._reply(200, 'DONE')
+
+    def _store(self, filename, data):
+        with open(os.path.join(self.server.directory, filename), 'wb') as f:
+            f.write(data)
+        self.server.received.append(filename)
+
+
+class ZendeskStandIn(StandInHandler):
+    """Answers uploads and ticket creation like the Zendesk API v2
+
+    Tickets created with an Idempotency-Key are only created once per
+    key; repeating the request returns the first ticket again.
+
+    create_many queues a job, which runs job_delay seconds later whether
+    anyone polls it or not, creating its tickets but a fraction
+    item_errors of them.  A create_many repeated with the same
+    Idempotency-Key returns the same job.
+    """
+
+    JOB = '/api/v2/job_statuses/'
+
+    def do_POST(self):
+        path, sep, query = self.path.partition('?')
+        # Uploads may be bigger than the memory of the machine
+        body = self._read_body(keep=path != '/api/v2/uploads.json')
+        if body is None:
+            return
+        if self._inject_error():
+            return
+
+        if path == '/api/v2/uploads.json':
+            self._upload(body, cgi.parse_qs(query))
+        elif path == '/api/v2/tickets.json':
+            self._ticket(body)
+        elif path == '/api/v2/tickets/create_many.json':
+            self._create_many(body)
+        else:
+            self._not_found()
+
+    def do_GET(self):
+        if self._read_body() is None:
+            return
+        if self._inject_error():
+            return
+
+        path, sep, query = self.path.partition('?')
+        if path.startswith(self.JOB) and path.endswith('.json'):
+            self._job_status(path[len(self.JOB):-len('.json')])
+        else:
+            self._not_found()
+
+    def _not_found(self):
+        self._reply(404, json.dumps({'error': 'InvalidEndpoint'}),
+                    'application/json')
+
+    def _upload(self, body, query):
+        digest, size = body
+        filename = query.get('filename', ['upload'])[0]
+        token = uuid.uuid4().hex
+        with self.server.lock:
+            self.server.uploads[token] = (filename, size, digest)
+        expires_at = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                   time.gmtime(time.time() + 3 * 24 * 3600))
+        self._reply(201, json.dumps({
+            'upload': {'token': token,
+                       'expires_at': expires_at,
+                       'attachment': {'file_name': filename,
+                                      'size': size}}}),
+                    'application/json')
+
+    def _ticket(self, body):
+        try:
+            ticket = json.loads(body)['ticket']
+        except (ValueError, KeyError):
+            self._reply(422, json.dumps({'error': 'RecordInvalid'}),
+                        'application/json')
+            return
+
+        key = self.headers.getheader('Idempotency-Key')
+        with self.server.lock:
+            if key and key in self.server.keys:
+                ticket = self.server.keys[key]
+            else:
+                ticket['id'] = len(self.server.tickets) + 1
+                self.server.tickets.append(ticket)
+                if key:
+                    self.server.keys[key] = ticket
+        self._reply(201, json.dumps({'ticket': ticket}), 'application/json')
+
+    def _create_many(self, body):
+        try:
+            tickets = json.loads(body)['tickets']
+        except (ValueError, KeyError):
+            self._reply(422, json.dumps({'error': 'RecordInvalid'}),
+                        'application/json')
+            return
+        if len(tickets) > 100:
+            self._reply(400, json.dumps({'error': 'TooManyTickets'}),
+                        'application/json')
+            return
+
+        key = self.headers.getheader('Idempotency-Key')
+        with self.server.lock:
+            if key and key in self.server.keys:
+                job = self.server.keys[key]
+            else:
+                job = {'id': uuid.uuid4().hex,
+                       'tickets': tickets,
+                       'polls': 0,
+                       'results': None}
+                self.server.jobs[job['id']] = job
+                if key:
+                    self.server.keys[key] = job
+                timer = threading.Timer(self.server.job_delay,
+                                        self._run_job, [job])
+                timer.daemon = True
+                timer.start()
+        self._reply(200, json.dumps({'job_status': self._job(job)}),
+                    'application/json')
+
+    def _job_status(self, job_id):
+        with self.server.lock:
+            job = self.server.jobs.get(job_id)
+            if job is None:
+                self._not_found()
+                return
+            job['polls'] += 1
+        self._reply(200, json.dumps({'job_status': self._job(job)}),
+                    'application/json')
+
+    def _run_job(self, job):
+        results = []
+        with self.server.lock:
+            for index, ticket in enumerate(job['tickets']):
+                if random.random() < self.server.item_errors:
+                    results.append({'index': index,
+                                    'status': 'Failed',
+                                    'error': 'RecordInvalid'})
+                    continue
+                ticket['id'] = len(self.server.tickets) + 1
+                self.server.tickets.append(ticket)
+                results.append({'index': index,
+                                'id': ticket['id'],
+                                'status': 'Created',
+                                'success': True})
+            job['results'] = results
+
+    def _job(self, job):
+        status = {'id': job['id'],
+                  'url': 'http://%s%s%s.json' % (
+                      self.headers.getheader('Host'), self.JOB, job['id']),
+                  'total': len(job['tickets'])}
+        if job['results'] is None:
+            status['status'] = job['polls'] and 'working' or 'queued'
+            status['progress'] = 0
+        else:
+            status['status'] = 'completed'
+            status['progress'] = len(job['tickets'])
+            status['results'] = job['results']
+        return status
+
+
+SERVICES = {'logs': LogReceiver, 'zendesk': ZendeskStandIn}
+
+
+def make_server(handler, port=0, drop=0.0, latency=0.0, bandwidth=0,
+                errors=0.0, status=503, item_errors=0.0, job_delay=0.2,
+                directory=None, quiet=True):
+    """Return a stand-in server for handler on localhost"""
+    server = StandInServer(('127.0.0.1', port), handler)
+    server.drop = drop
+    server.latency = latency
+    server.bandwidth = bandwidth
+    server.errors = errors
+    server.status = status
+    server.item_errors = item_errors
+    server.job_delay = job_delay
+    server.dropped = 0
+    server.connections = 0
+    server.requests = 0
+    server.received = []
+    server.uploads = {}
+    server.tickets = []
+    server.keys = {}
+    server.jobs = {}
+    server.directory = directory or os.getcwd()
+    server.quiet = quiet
+    server.lock = threading.Lock()
+    return server
+
+
+def start(handler, **kwargs):
+    """Serve handler in a background thread, see make_server()
+
+    The server's URL base is http://127.0.0.1:<server.server_port>.
+    """
+    server = make_server(handler, **kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='python -m backend.standin',
+                                     description=__doc__.splitlines()[0])
+    parser.add_argument('service', choices=sorted(SERVICES.keys()))
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--drop', type=float, default=0.0,
+                        help='fraction of requests to drop, 0 to 1')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds to wait before answering')
+    parser.add_argument('--bandwidth', type=int, default=0,
+                        help='bytes per second to read request bodies at')
+    parser.add_argument('--errors', type=float, default=0.0,
+                        help='fraction of requests to fail, 0 to 1')
+    parser.add_argument('--status', type=int, default=503,
+                        help='status code of the failed requests')
+    parser.add_argument('--item-errors', type=float, default=0.0,
+                        help='fraction of create_many tickets to fail')
+    parser.add_argument('--job-delay', type=float, default=0.2,
+                        help='seconds before a create_many job runs')
+    parser.add_argument('--dir', default=os.getcwd(),
+                        help='where to store what was received')
+    args = parser.parse_args(argv[1:])
+
+    server = make_server(SERVICES[args.service], port=args.port,
+                         drop=args.drop, latency=args.latency,
+                         bandwidth=args.bandwidth, errors=args.errors,
+                         status=args.status, item_errors=args.item_errors,
+                         job_delay=args.job_delay, directory=args.dir,
+                         quiet=False)
+
+    print 'Stand-in %s server on http://127.0.0.1:%d' % (args.service,
+                                                         args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
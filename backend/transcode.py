@@ -0,0 +1,116 @@
+# Copyright (c) 2014 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+import os
+import logging
+from tempfile import mkstemp
+
+from gi.repository import GdkPixbuf
+
+# Images bigger than IMAGE_MAX_BYTES are scaled down to at most
+# IMAGE_MAX_SIDE pixels wide and high and saved again, as PNG if that
+# gets them under IMAGE_MAX_BYTES, else as JPEG of JPEG_QUALITY if they
+# have no transparency, whichever is smallest.
+IMAGE_MAX_BYTES = 512 * 1024
+IMAGE_MAX_SIDE = 1600
+JPEG_QUALITY = 80
+
+IMAGE_TYPES = ['image/png', 'image/jpeg']
+
+
+def transcode_image(file, max_bytes=IMAGE_MAX_BYTES,
+                    max_side=IMAGE_MAX_SIDE, quality=JPEG_QUALITY):
+    """
+    Return a smaller copy of an image to upload instead of it.
+
+    file: file dict as in reporter.send_report
+
+    Returns a new file dict for a temporary file, with 'original' set to
+    the path of the image, which the caller removes once it is uploaded.
+    Returns file itself if it is not an image, small enough already, or
+    could not be made smaller.
+    """
+    if file.get('type') not in IMAGE_TYPES:
+        return file
+    try:
+        size = os.path.getsize(file['path'])
+    except OSError:
+        return file
+    if size <= max_bytes:
+        return file
+
+    try:
+        return _transcode(file, size, max_bytes, max_side, quality)
+    except Exception as error:
+        logging.error('transcode %s failed, sending it as it is: %s',
+                      file['name'], str(error))
+        return file
+
+
+def _transcode(file, size, max_bytes, max_side, quality):
+    info, width, height = GdkPixbuf.Pixbuf.get_file_info(file['path'])
+    if info is None:
+        return file
+
+    scale = min(1.0, float(max_side) / max(width, height))
+    if scale < 1.0:
+        pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(
+            file['path'], max(1, int(width * scale)),
+            max(1, int(height * scale)), True)
+    else:
+        pixbuf = GdkPixbuf.Pixbuf.new_from_file(file['path'])
+
+    # GdkPixbuf cannot write palette PNGs, so PNGs only get the best
+    # zlib level; JPEG is the fallback for everything opaque
+    formats = []
+    if file['type'] == 'image/png':
+        formats.append(('png', 'image/png', '.png',
+                        ['compression'], ['9']))
+    if not pixbuf.get_has_alpha():
+        formats.append(('jpeg', 'image/jpeg', '.jpg',
+                        ['quality'], [str(quality)]))
+
+    best = None
+    for name, mime_type, suffix, keys, values in formats:
+        fd, path = mkstemp(suffix=suffix)
+        os.close(fd)
+        try:
+            pixbuf.savev(path, name, keys, values)
+        except Exception:
+            os.remove(path)
+            raise
+        saved = (os.path.getsize(path), path, mime_type, suffix)
+        if best is None or saved < best:
+            if best is not None:
+                os.remove(best[1])
+            best = saved
+        else:
+            os.remove(path)
+        # Lossless and small enough, no need to try JPEG
+        if best[0] <= max_bytes and best[2] == 'image/png':
+            break
+
+    if best is None:
+        return file
+    saved_size, path, mime_type, suffix = best
+    if saved_size >= size:
+        os.remove(path)
+        return file
+
+    name = file['name']
+    if mime_type != file['type']:
+        name = os.path.splitext(name)[0] + suffix
+    logging.debug('transcode %s: %d bytes to %d as %s', file['name'],
+                  size, saved_size, mime_type)
+    return {'path': path,
+            'name': name,
+            'type': mime_type,
+            'original': file['path']}
@@ -0,0 +1,100 @@
+# Copyright (c) 2014 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+import os
+import json
+import time
+import hashlib
+import calendar
+import threading
+# time.strptime imports this lazily, which is not thread safe in Python 2
+import _strptime
+
+UPLOAD_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.sugar',
+                                 'default', 'onesupport', 'uploads.json')
+
+# How long a token is trusted when the server did not say when it
+# expires, and how long before its expiry a token is no longer handed out
+UPLOAD_TOKEN_TTL = 60 * 60
+UPLOAD_TOKEN_MARGIN = 10 * 60
+
+CHUNK_SIZE = 65536
+
+
+def file_digest(path):
+    """Return the SHA-256 of a file, read a chunk at a time"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(CHUNK_SIZE), ''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def parse_expiry(expires_at):
+    """Return the epoch time of a Zendesk expires_at value, or None"""
+    if not expires_at:
+        return None
+    try:
+        return calendar.timegm(time.strptime(expires_at,
+                                             '%Y-%m-%dT%H:%M:%SZ'))
+    except (TypeError, ValueError):
+        return None
+
+
+class UploadCache(object):
+    """
+    Maps the SHA-256 of uploaded files to their upload token and its
+    expiry, so the same bytes are not uploaded again while the token is
+    still good.  Safe to use from several upload threads.
+    """
+
+    def __init__(self, path=UPLOAD_CACHE_PATH):
+        self._path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+
+        try:
+            with open(path) as f:
+                self._entries = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    def get(self, digest):
+        """Return a token still good for digest, or None"""
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            if entry['expires'] - UPLOAD_TOKEN_MARGIN < time.time():
+                del self._entries[digest]
+                return None
+            return entry['token']
+
+    def put(self, digest, token, expires=None):
+        if expires is None:
+            expires = time.time() + UPLOAD_TOKEN_TTL
+        with self._lock:
+            self._entries[digest] = {'token': token, 'expires': expires}
+
+    def save(self):
+        """Write the cache, leaving out the tokens that expired"""
+        with self._lock:
+            now = time.time()
+            entries = dict([(digest, entry)
+                            for digest, entry in self._entries.items()
+                            if entry['expires'] > now])
+
+        directory = os.path.dirname(self._path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self._path + '.tmp', 'w') as f:
+            json.dump(entries, f)
+        os.rename(self._path + '.tmp', self._path)
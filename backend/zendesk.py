@@ -9,11 +9,30 @@
 # along with this library; if not, write to the Free Software
 # Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
 
+import os
 import json
+import time
+import threading
+from collections import namedtuple
 
 from gi.repository import GConf
 from gi.repository import Soup
 
+from backend.logcollect import monotonic
+
+# The one session all requests share, so connections (and their TLS
+# handshakes) are reused across attachments and tickets.  How many
+# connections it may keep open and for how many idle seconds.
+SESSION_MAX_CONNS = 4
+SESSION_IDLE_TIMEOUT = 60
+
+_session = None
+_session_lock = threading.Lock()
+_connections_created = 0
+
+# Attachments are streamed from disk in pieces of this size
+CHUNK_SIZE = 65536
+
 
 class ConfigError(Exception):
     pass
@@ -27,17 +46,120 @@ class ServerError(Exception):
     pass
 
 
+class Cancelled(Exception):
+    pass
+
+
+# The Zendesk settings, read from GConf once and checked up front, and
+# read again only after GConf said they changed.
+ZendeskConfig = namedtuple('ZendeskConfig', ['url', 'token', 'fields'])
+
+CONFIG_DIR = '/desktop/sugar/services/zendesk'
+
+_config = None
+_config_lock = threading.Lock()
+_config_watched = False
+
+
+def _load_config():
+    client = GConf.Client.get_default()
+    url = client.get_string(Request.URL)
+    token = client.get_string(Request.TOKEN)
+    if not url or not token:
+        raise ConfigError('soupdesk is missing URL or TOKEN')
+
+    # FIXME #3926 GConf get_list is missing
+    raw = client.get(FieldHelper.IDS)
+    if not raw:
+        raise ConfigError('soupdesk is missing fields')
+    try:
+        fields = tuple([int(e.get_string()) for e in raw.get_list()])
+    except ValueError as error:
+        raise ConfigError('soupdesk has invalid fields: %s' % error)
+
+    return ZendeskConfig(url, token, fields)
+
+
+def _config_changed_cb(client, connection_id, entry, data):
+    global _config
+    with _config_lock:
+        _config = None
+
+
+def _watch_config():
+    global _config_watched
+    if _config_watched:
+        return
+    try:
+        client = GConf.Client.get_default()
+        client.add_dir(CONFIG_DIR, GConf.ClientPreloadType.PRELOAD_NONE)
+        client.notify_add(CONFIG_DIR, _config_changed_cb, None)
+        _config_watched = True
+    except Exception:
+        pass
+
+
+def get_config():
+    """Return the current ZendeskConfig, raising ConfigError if the
+    settings are missing or invalid"""
+    global _config
+    with _config_lock:
+        if _config is None:
+            _config = _load_config()
+            _watch_config()
+        return _config
+
+
+def set_config(config):
+    """Use config instead of the GConf settings, until they change"""
+    global _config
+    with _config_lock:
+        _config = config
+
+
+def _connection_created_cb(session, connection):
+    global _connections_created
+    _connections_created += 1
+
+
+def get_session():
+    """Return the process-wide session, creating it on first use"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = Soup.SessionSync()
+            _session.props.max_conns = SESSION_MAX_CONNS
+            _session.props.max_conns_per_host = SESSION_MAX_CONNS
+            _session.props.idle_timeout = SESSION_IDLE_TIMEOUT
+            _session.add_feature_by_type(Soup.ProxyResolverDefault)
+            _session.connect('connection-created', _connection_created_cb)
+        return _session
+
+
+def configure_session(max_conns=None, idle_timeout=None):
+    """Change the pool size or idle timeout, for the sessions to come"""
+    global _session, SESSION_MAX_CONNS, SESSION_IDLE_TIMEOUT
+    with _session_lock:
+        if max_conns is not None:
+            SESSION_MAX_CONNS = max_conns
+        if idle_timeout is not None:
+            SESSION_IDLE_TIMEOUT = idle_timeout
+        if _session is not None:
+            _session.abort()
+            _session = None
+
+
+def connections_created():
+    """Return how many connections (and so handshakes) were opened so far"""
+    return _connections_created
+
+
 class FieldHelper(object):
 
     IDS = '/desktop/sugar/services/zendesk/fields'
 
     def __init__(self):
-        # FIXME #3926 GConf get_list is missing
-        client = GConf.Client.get_default()
-        raw = client.get(self.IDS)
-        if not raw:
-            raise ConfigError('soupdesk is missing fields')
-        self._ids = [int(e.get_string()) for e in raw.get_list()]
+        self._ids = get_config().fields
 
     def get_field(self, index, value):
         field = {}
@@ -52,32 +174,96 @@ class Request(object):
     TOKEN = '/desktop/sugar/services/zendesk/token'
 
     def __init__(self):
-        client = GConf.Client.get_default()
-        self._url = client.get_string(self.URL)
-        self._token = client.get_string(self.TOKEN)
+        config = get_config()
+        self._url = config.url
+        self._token = config.token
         self._data = None
         self._code = None
-
-        if not self._url or not self._token:
-            raise ConfigError('soupdesk is missing URL or TOKEN')
+        # Timing, size, status and restarts of the last request
+        self.stats = None
 
     def _authorize(self):
         return 'Basic %s' % self._token
 
-    def _request(self, method, url, data, content):
+    def _stream(self, message, source, progress=None, cancel=None):
+        """Make message send the open file source as its body, a chunk
+        at a time, dropping every chunk once it was written.
+
+        progress, if given, is called with the number of bytes written
+        so far; setting the cancel event stops the message."""
+        size = os.fstat(source.fileno()).st_size
+        message.request_headers.set_encoding(Soup.Encoding.CONTENT_LENGTH)
+        message.request_headers.set_content_length(size)
+        # Without CAN_REBUILD libsoup keeps every chunk for a restart
+        message.set_flags(message.get_flags() |
+                          Soup.MessageFlags.CAN_REBUILD)
+        message.request_body.set_accumulate(False)
+
+        def next_chunk(message):
+            if cancel is not None and cancel.is_set():
+                get_session().cancel_message(message, Soup.Status.CANCELLED)
+                return
+            if progress is not None:
+                progress(source.tell())
+            data = source.read(CHUNK_SIZE)
+            if data:
+                message.request_body.append(data)
+            else:
+                message.request_body.complete()
+
+        def restarted(message):
+            # A redirect or a dropped connection sends everything again;
+            # libsoup emptied the body, so it is appended from the start
+            source.seek(0)
+
+        message.connect('wrote-headers', next_chunk)
+        message.connect('wrote-chunk', next_chunk)
+        message.connect('restarted', restarted)
+
+    def _request(self, method, url, data, content, headers=None,
+                 progress=None, cancel=None):
+        """data is either a string or a file open for reading, which is
+        then streamed instead of being read into memory.  Raises
+        Cancelled if the cancel event was set before or while sending."""
+        if cancel is not None and cancel.is_set():
+            raise Cancelled('cancelled before sending')
+
         uri = Soup.URI.new(url)
 
         message = Soup.Message(method=method, uri=uri)
-        message.request_body.append(data)
+        if isinstance(data, basestring):
+            size = len(data)
+            message.request_body.append(data)
+        else:
+            size = os.fstat(data.fileno()).st_size
+            self._stream(message, data, progress, cancel)
         message.request_headers.append('Content-Type', content)
         message.request_headers.append('Authorization', self._authorize())
+        for name, value in (headers or {}).items():
+            message.request_headers.append(name, value)
+
+        restarts = [0]
 
-        session = Soup.SessionSync()
-        session.add_feature_by_type(Soup.ProxyResolverDefault)
-        session.send_message(message)
+        def restarted(message):
+            restarts[0] += 1
+
+        message.connect('restarted', restarted)
+
+        started = monotonic()
+        get_session().send_message(message)
 
         self._data = message.response_body.data
         self._code = message.status_code
+        self.stats = {'method': method,
+                      'path': uri.get_path(),
+                      'status': self._code,
+                      'seconds': monotonic() - started,
+                      'bytes': size,
+                      'restarts': restarts[0]}
+
+        if cancel is not None and cancel.is_set() and \
+                self._code == Soup.Status.CANCELLED:
+            raise Cancelled('cancelled while sending')
 
         if self._code < 100:
             raise NetworkError('transmission failed with %d, %s, %s',
@@ -93,12 +279,49 @@ class Request(object):
 class Ticket(Request):
 
     RESOURCE = '/api/v2/tickets.json'
+    MANY_RESOURCE = '/api/v2/tickets/create_many.json'
     CONTENT = 'application/json'
 
+    # The most tickets Zendesk takes in one create_many
+    MANY_MAX = 100
+
     def _endpoint(self):
         return '%s%s' % (self._url, self.RESOURCE)
 
-    def create(self, subject, body, uploads, name, email, fields):
+    def create(self, subject, body, uploads, name, email, fields, key=None):
+        """key, if given, makes retries of the same create harmless:
+        the server creates at most one ticket per key."""
+        self.create_ticket(self.ticket(subject, body, uploads, name, email,
+                                       fields), key)
+
+    def create_ticket(self, ticket, key=None):
+        """Create a ticket built by ticket(), see create()"""
+        data = json.dumps({'ticket': ticket})
+        headers = {}
+        if key:
+            headers['Idempotency-Key'] = key
+        self._request('POST', self._endpoint(), data, self.CONTENT, headers)
+
+    def create_many(self, tickets, key=None):
+        """
+        Queue the creation of up to MANY_MAX tickets built by ticket(),
+        in one request, and return the job status to follow it with
+        JobStatus.  key makes sending the same batch again harmless, as
+        in create(): the server queues at most one job per key.
+        """
+        if len(tickets) > self.MANY_MAX:
+            raise ValueError('at most %d tickets at once' % self.MANY_MAX)
+        data = json.dumps({'tickets': tickets})
+        headers = {}
+        if key:
+            headers['Idempotency-Key'] = key
+        self._request('POST', '%s%s' % (self._url, self.MANY_RESOURCE),
+                      data, self.CONTENT, headers)
+        return json.loads(self._data)['job_status']
+
+    @staticmethod
+    def ticket(subject, body, uploads, name, email, fields):
+        """Return the ticket create() would create"""
         ticket = {}
         ticket['subject'] = subject
         ticket['comment'] = {}
@@ -111,8 +334,47 @@ class Ticket(Request):
             ticket['requester']['email'] = email
         if fields:
             ticket['custom_fields'] = fields
-        data = json.dumps({'ticket': ticket})
-        self._request('POST', self._endpoint(), data, self.CONTENT)
+        return ticket
+
+
+class JobStatus(Request):
+    """Follows the background job of a Ticket.create_many()"""
+
+    RESOURCE = '/api/v2/job_statuses/%s.json'
+    CONTENT = 'application/json'
+
+    # Seconds between polls, and how long a job may take
+    POLL_INTERVAL = 1
+    POLL_TIMEOUT = 120
+
+    DONE = ['completed', 'failed', 'killed']
+
+    def get(self, job_id):
+        self._request('GET', self._url + self.RESOURCE % job_id, '',
+                      self.CONTENT)
+        return json.loads(self._data)['job_status']
+
+    def wait(self, job_id, interval=None, timeout=None):
+        """
+        Return the job status once the job is done, with its 'results':
+        per ticket its 'index' in the batch and the 'id' it was given,
+        or an 'error' if it was not created.  Polls every interval
+        seconds, POLL_INTERVAL by default, and raises ServerError if the
+        job takes longer than timeout seconds, POLL_TIMEOUT by default.
+        """
+        if interval is None:
+            interval = self.POLL_INTERVAL
+        if timeout is None:
+            timeout = self.POLL_TIMEOUT
+        started = monotonic()
+        while True:
+            status = self.get(job_id)
+            if status['status'] in self.DONE:
+                return status
+            if monotonic() - started > timeout:
+                raise ServerError('job %s still %s after %gs' %
+                                  (job_id, status['status'], timeout))
+            time.sleep(interval)
 
 
 class Attachment(Request):
@@ -123,12 +385,18 @@ class Attachment(Request):
         endpoint = '%s%s?filename=%s' % (self._url, self.RESOURCE, filename)
         return endpoint
 
-    def create(self, path, filename, content):
+    def create(self, path, filename, content, progress=None, cancel=None):
         with open(path, 'rb') as source:
-            data = source.read()
-        self._request('POST', self._endpoint(filename), data, content)
+            self._request('POST', self._endpoint(filename), source, content,
+                          progress=progress, cancel=cancel)
 
     def token(self):
         if self._data is None:
             return None
         return json.loads(self._data)['upload']['token']
+
+    def expires_at(self):
+        """Return the expires_at the server gave the token, if any"""
+        if self._data is None:
+            return None
+        return json.loads(self._data)['upload'].get('expires_at')
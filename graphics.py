@@ -277,6 +277,14 @@ class Graphics(Gtk.Alignment):
         button.show()
         return button
 
+    def add_progress_bar(self):
+        progress_bar = Gtk.ProgressBar()
+        progress_bar.set_size_request(style.GRID_CELL_SIZE * 8, -1)
+        progress_bar.set_show_text(True)
+        self._attach_center(progress_bar)
+        progress_bar.show()
+        return progress_bar
+
     def add_yes_no_buttons(self, callback):
         grid = Gtk.Grid()
         grid.set_row_spacing(style.DEFAULT_SPACING)
@@ -10,14 +10,641 @@
 # Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
 
 import os
+import uuid
+import hashlib
+import Queue
 import logging
+import threading
 from tempfile import NamedTemporaryFile
 
-from backend.logcollect import LogCollect
-from backend.zendesk import FieldHelper, Ticket, Attachment
+from backend.logcollect import LogCollect, monotonic, background_priority
+from backend.zendesk import FieldHelper, Ticket, Attachment, JobStatus
+from backend.zendesk import connections_created, NetworkError, ServerError
+from backend.zendesk import Cancelled
+from backend.zendesk import get_config
+from backend.uploadcache import UploadCache, file_digest, parse_expiry
+from backend.metrics import Metrics
+from backend.transcode import transcode_image
 
+# How many attachments are uploaded at the same time
+UPLOAD_WORKERS = 3
 
-def send_report(data):
+# Whether big screenshots and photos are scaled down and recompressed
+# before they are uploaded, see backend/transcode.py
+TRANSCODE_IMAGES = True
+
+# Bytes the log archive of a report should come close to, so it stays
+# affordable on metered connections; 0 sends every log whole
+LOG_BUDGET = 2 * 1024 * 1024
+
+# Bytes of LOG_BUDGET an archive built in the background leaves free for
+# what the logs gain until the report is submitted
+LOG_REFRESH_ROOM = LOG_BUDGET / 8
+
+# Seconds submitting waits for a background archive that is still being
+# built before it archives the logs itself, at normal priority
+PRECOLLECT_WAIT = 10
+
+
+class UploadPool(object):
+    """
+    Uploads files on up to workers threads as they are added, so uploads
+    can start before every file of a report exists.
+
+    cache: UploadCache of tokens to reuse for files uploaded before,
+           a new one (from disk) by default
+    progress, cancel: as in send_report
+    metrics: Metrics to add the stats of every upload to
+    transform: function taking a file dict and returning the one to
+               upload instead, as transcode_image() does
+    """
+
+    def __init__(self, workers=UPLOAD_WORKERS, cache=None, progress=None,
+                 cancel=None, metrics=None, transform=None):
+        if cache is None:
+            cache = UploadCache()
+        self._workers = workers
+        self._cache = cache
+        self._progress = progress
+        self._cancel = cancel
+        self._metrics = metrics
+        self._transform = transform
+        self._pending = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._files = []
+        self._sizes = []
+        self._sent = []
+        self._results = []
+        self._started = monotonic()
+
+    def add(self, file):
+        """Queue a file dict as in send_report for uploading"""
+        try:
+            size = os.path.getsize(file['path'])
+        except OSError:
+            # _upload() fails on it and says why
+            size = 0
+        with self._lock:
+            index = len(self._files)
+            self._files.append(file)
+            self._sizes.append(size)
+            self._sent.append(0)
+            self._results.append(None)
+        self._pending.put((index, file))
+
+        if len(self._threads) < self._workers:
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _cancelled(self):
+        return self._cancel is not None and self._cancel.is_set()
+
+    def _report(self, index, count):
+        with self._lock:
+            self._sent[index] = count
+            done = sum(self._sent)
+            total = sum(self._sizes)
+        if self._progress is not None:
+            self._progress('upload', done, total)
+
+    def _work(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            if self._cancelled():
+                continue
+            index, file = item
+            self._results[index] = self._upload(index, file)
+
+    def _upload(self, index, file):
+        metrics = self._metrics
+        attachment = None
+        # The token is cached under the digest of the file itself, so a
+        # file uploaded before is not transformed again
+        upload = file
+        try:
+            digest = file_digest(file['path'])
+            token = self._cache.get(digest)
+            if token is None:
+                if self._transform is not None:
+                    upload = self._transform(file)
+                if upload is not file:
+                    with self._lock:
+                        self._sizes[index] = os.path.getsize(upload['path'])
+                attachment = Attachment()
+                attachment.create(upload['path'],
+                                  upload['name'],
+                                  upload['type'],
+                                  lambda count: self._report(index, count),
+                                  self._cancel)
+                token = attachment.token()
+                self._cache.put(digest, token,
+                                parse_expiry(attachment.expires_at()))
+        except Exception as error:
+            logging.error('report.upload_files %s failed: %s',
+                          file['name'], str(error))
+            if metrics is not None:
+                metrics.request(attachment and attachment.stats,
+                                name=file['name'], error=str(error))
+            return (None, error)
+        finally:
+            if upload is not file:
+                os.remove(upload['path'])
+
+        self._report(index, self._sizes[index])
+        if metrics is not None:
+            if attachment is None:
+                metrics.request(None, name=file['name'],
+                                bytes=self._sizes[index], cached=True)
+            elif upload is not file:
+                metrics.request(attachment.stats, name=file['name'],
+                                original_bytes=os.path.getsize(file['path']))
+            else:
+                metrics.request(attachment.stats, name=file['name'])
+        return (token, None)
+
+    def finish(self):
+        """
+        Wait for every file added to be uploaded.
+
+        Returns (tokens, failed): the upload tokens in the order the files
+        were added, leaving out those that failed, and a list of
+        (file, error) for the ones that did.  Raises Cancelled if cancel
+        was set meanwhile.
+        """
+        for thread in self._threads:
+            self._pending.put(None)
+        for thread in self._threads:
+            thread.join()
+        if self._metrics is not None:
+            self._metrics.set_phase('upload', monotonic() - self._started)
+
+        try:
+            self._cache.save()
+        except (IOError, OSError) as error:
+            logging.error('report.upload_files cache not saved: %s',
+                          str(error))
+
+        if self._cancelled():
+            raise Cancelled('upload cancelled')
+
+        tokens = []
+        failed = []
+        for file, (token, error) in zip(self._files, self._results):
+            if error is None:
+                tokens.append(token)
+            else:
+                failed.append((file, error))
+        return tokens, failed
+
+
+def upload_files(files, workers=UPLOAD_WORKERS, cache=None, progress=None,
+                 cancel=None, metrics=None, transform=None):
+    """
+    Upload files concurrently, at most workers at a time, see UploadPool.
+
+    files: list of file dicts as in send_report
+
+    Returns (tokens, failed) as UploadPool.finish() does.
+    """
+    pool = UploadPool(min(workers, len(files)), cache, progress, cancel,
+                      metrics, transform)
+    for file in files:
+        pool.add(file)
+    return pool.finish()
+
+
+def _transform():
+    if TRANSCODE_IMAGES:
+        return transcode_image
+    return None
+
+
+def _save_metrics(metrics):
+    try:
+        metrics.save()
+    except (IOError, OSError) as error:
+        logging.error('report metrics not saved: %s', str(error))
+
+
+def _upload_metrics(metrics):
+    """Upload the metrics so far as metrics.json, return its token"""
+    tempfile = NamedTemporaryFile(suffix='.json', delete=False)
+    try:
+        tempfile.write(metrics.dumps())
+        tempfile.close()
+        attachment = Attachment()
+        attachment.create(tempfile.name, 'metrics.json', 'application/json')
+        return attachment.token()
+    except Exception as error:
+        logging.error('report metrics not attached: %s', str(error))
+        return None
+    finally:
+        os.remove(tempfile.name)
+
+
+def deliver_report(data, progress=None, cancel=None, metrics=None,
+                   pool=None):
+    """
+    Upload data['files'] and create the ticket.
+
+    data: dict as in send_report, with a 'key' that keeps a retried
+          delivery from creating a second ticket
+    progress, cancel: as in send_report
+    metrics: Metrics of this report, which is attached as metrics.json.
+             Without it one is made, and saved once the delivery is done.
+    pool: UploadPool that data['files'] were already added to
+
+    Returns the list of (file, error) that could not be uploaded, these
+    are listed in the ticket body instead.
+    """
+    if metrics is not None:
+        return _deliver_report(data, progress, cancel, metrics, pool)
+
+    metrics = Metrics(data.get('key'))
+    try:
+        failed = _deliver_report(data, progress, cancel, metrics, pool)
+        metrics.set('result', 'sent')
+        return failed
+    except Exception as error:
+        metrics.set('result', error.__class__.__name__)
+        raise
+    finally:
+        _save_metrics(metrics)
+
+
+def _deliver_report(data, progress, cancel, metrics, pool):
+    ticket_data, failed = _prepare_report(data, progress, cancel, metrics,
+                                          pool)
+
+    if cancel is not None and cancel.is_set():
+        raise Cancelled('cancelled before the ticket was created')
+    if progress is not None:
+        progress('ticket', 0, 0)
+
+    ticket = Ticket()
+    with metrics.phase('ticket'):
+        try:
+            ticket.create_ticket(ticket_data, data.get('key'))
+        finally:
+            metrics.request(ticket.stats, name='ticket')
+
+    return failed
+
+
+def _prepare_report(data, progress, cancel, metrics, pool):
+    """Upload the files of a report, return its ticket and failed files"""
+    metrics.set('attempts', data.get('attempts', 0))
+    if pool is None:
+        pool = UploadPool(progress=progress, cancel=cancel, metrics=metrics,
+                          transform=_transform())
+        for file in data['files']:
+            pool.add(file)
+    uploads, failed = pool.finish()
+
+    # So a slow report can be looked into from the ticket itself
+    token = _upload_metrics(metrics)
+    if token is not None:
+        uploads.append(token)
+
+    body = data['body']
+    if failed:
+        body += '\n\nThese attachments could not be uploaded:\n'
+        for file, error in failed:
+            body += '- %s (%s)\n' % (file['name'], error)
+
+    helper = FieldHelper()
+    fields = []
+    try:
+        fields.append(helper.get_field(2, data['school']))
+        fields.append(helper.get_field(4, data['phone']))
+        fields.append(helper.get_field(5, data['serial']))
+        fields.append(helper.get_field(6, data['build']))
+    except Exception as error:
+        logging.error('report.send_report missing ids: %s', str(error))
+
+    ticket = Ticket.ticket(data['subject'], body, uploads, data['name'],
+                           data['email'], fields)
+    return ticket, failed
+
+
+def deliver_reports(reports, keep_job=None):
+    """
+    Deliver several reports, e.g. a drained outbox, creating their
+    tickets Ticket.MANY_MAX at a time instead of one request each.
+
+    reports: list of data dicts as in deliver_report
+    keep_job: function called as keep_job(index, job) whenever the batch
+              of reports[index] changes, job being None once it is
+              settled, so the caller can keep it with the report.  A
+              report delivered again with that job as data['job'] has
+              the job followed instead of its ticket created again.
+
+    Tickets a finished job reports as failed are created one by one.
+    The metrics of every report are saved once it is done.
+
+    Returns one entry per report: None if it was sent, else the
+    NetworkError or ServerError it failed with.
+    """
+    errors = [None] * len(reports)
+    metrics = [Metrics(data.get('key')) for data in reports]
+
+    def keep(index, job):
+        reports[index]['job'] = job
+        if keep_job is not None:
+            keep_job(index, job)
+
+    sent, single = _follow_jobs(reports, keep, metrics, errors)
+
+    tickets = {}
+    for index, data in enumerate(reports):
+        if index in sent or errors[index] is not None:
+            continue
+        try:
+            tickets[index], failed = _prepare_report(data, None, None,
+                                                     metrics[index], None)
+        except (NetworkError, ServerError) as error:
+            errors[index] = error
+
+    # Batches that may have reached the server go again as they were,
+    # under the same key, so it can tell them apart from new ones
+    again = {}
+    fresh = []
+    for index in sorted(tickets.keys()):
+        if index in single:
+            continue
+        job = reports[index].get('job')
+        if job is None:
+            fresh.append(index)
+        else:
+            again.setdefault(job['key'], []).append((job['index'], index))
+    batches = [(key, [index for position, index in sorted(batch)])
+               for key, batch in again.items()]
+
+    # Batching pays off from two tickets up; a lone one goes as always
+    if len(fresh) == 1:
+        single.append(fresh[0])
+    else:
+        for start in range(0, len(fresh), Ticket.MANY_MAX):
+            batch = fresh[start:start + Ticket.MANY_MAX]
+            key = hashlib.sha1(' '.join([reports[index].get('key') or ''
+                                         for index in batch])).hexdigest()
+            batches.append((key, batch))
+
+    for key, batch in batches:
+        single += _create_many(tickets, batch, key, keep, metrics, errors)
+
+    for index in sorted(single):
+        if index not in tickets:
+            continue
+        ticket = Ticket()
+        with metrics[index].phase('ticket'):
+            try:
+                ticket.create_ticket(tickets[index],
+                                     reports[index].get('key'))
+            except (NetworkError, ServerError) as error:
+                errors[index] = error
+            finally:
+                metrics[index].request(ticket.stats, name='ticket')
+
+    for index, error in enumerate(errors):
+        metrics[index].set('result', error is None and 'sent' or
+                           error.__class__.__name__)
+        _save_metrics(metrics[index])
+    return errors
+
+
+def _follow_jobs(reports, keep, metrics, errors):
+    """
+    Wait for the jobs that earlier deliveries of reports handed their
+    tickets to, setting errors[index] for the ones still not done.
+
+    Returns the set of indexes whose ticket the job created, and the
+    list of those it did not, which are to be created one by one.
+    """
+    jobs = {}
+    for index, data in enumerate(reports):
+        job = data.get('job')
+        if job is not None and job.get('id') is not None:
+            jobs.setdefault(job['id'], []).append(index)
+
+    sent = set()
+    single = []
+    for job_id, indexes in jobs.items():
+        job = JobStatus()
+        try:
+            status = job.wait(job_id)
+        except ServerError as error:
+            if job.stats is None or job.stats['status'] != 404:
+                for index in indexes:
+                    errors[index] = error
+                continue
+            # Zendesk forgets jobs after a while, this one is history
+            logging.error('report: job %s is gone, creating its tickets '
+                          'one by one', job_id)
+            status = {'results': []}
+        except NetworkError as error:
+            for index in indexes:
+                errors[index] = error
+            continue
+        except (KeyError, ValueError) as error:
+            logging.error('report: job %s answered without a status, '
+                          'creating its tickets one by one: %r',
+                          job_id, error)
+            status = {'results': []}
+        finally:
+            for index in indexes:
+                metrics[index].request(job.stats, name='job status')
+
+        created = _created(status)
+        for index in indexes:
+            if reports[index]['job']['index'] in created:
+                sent.add(index)
+            else:
+                single.append(index)
+            keep(index, None)
+    return sent, single
+
+
+def _created(status):
+    """Return the positions in its batch of the tickets a job created"""
+    return set([result['index'] for result in status.get('results') or []
+                if result.get('id') is not None])
+
+
+def _create_many(tickets, batch, key, keep, metrics, errors):
+    """
+    Create the tickets[index] of every index in batch in one create_many
+    job under key, setting errors[index] for the ones that are not known
+    to be created or failed by the end of it.
+
+    Returns the indexes that are to be created one by one.
+    """
+    started = monotonic()
+    ticket = Ticket()
+    job = JobStatus()
+    for position, index in enumerate(batch):
+        keep(index, {'key': key, 'index': position, 'id': None})
+    try:
+        status = ticket.create_many([tickets[index] for index in batch], key)
+        for position, index in enumerate(batch):
+            keep(index, {'key': key, 'index': position, 'id': status['id']})
+        status = job.wait(status['id'])
+    except ServerError as error:
+        if job.stats is None:
+            # Refused, so there is no job to wait for
+            for index in batch:
+                keep(index, None)
+            if ticket.stats['status'] != 429:
+                # e.g. by an older server
+                logging.error('report: batch of %d refused, creating them '
+                              'one by one: %s', len(batch), error)
+                return batch
+        # Else the job may still create them, the next delivery follows it
+        for index in batch:
+            errors[index] = error
+        return []
+    except NetworkError as error:
+        for index in batch:
+            errors[index] = error
+        return []
+    except (KeyError, ValueError) as error:
+        # No job_status, or not JSON at all
+        for index in batch:
+            keep(index, None)
+        logging.error('report: batch of %d got no job status, creating them '
+                      'one by one: %r', len(batch), error)
+        return batch
+    finally:
+        for index in batch:
+            metrics[index].set_phase('ticket', monotonic() - started)
+            metrics[index].request(ticket.stats, name='tickets',
+                                   batch=len(batch))
+            if job.stats:
+                metrics[index].request(job.stats, name='job status')
+
+    created = _created(status)
+    for index in batch:
+        keep(index, None)
+    left = [index for position, index in enumerate(batch)
+            if position not in created]
+    if left:
+        logging.error('report: batch created %d of %d tickets, creating the '
+                      'rest one by one', len(batch) - len(left), len(batch))
+    return left
+
+
+def collect_logs():
+    """Archive the logs now, return (collector, archive path)"""
+    tempfile = NamedTemporaryFile(suffix='.zip', delete=False)
+    tempfile.close()
+
+    collector = LogCollect()
+    try:
+        collector.write_logs(archive=tempfile.name, logbytes=0,
+                             incremental=True, codec='auto', fold=True,
+                             budget=LOG_BUDGET)
+    except Exception:
+        os.remove(tempfile.name)
+        raise
+    return collector, tempfile.name
+
+
+class LogPrecollector(object):
+    """
+    Archives the logs of a report in the background, at the lowest CPU
+    and I/O priority, while the user is still filling the report in.  At submit
+    time the archive only needs what the logs gained since.
+    """
+
+    def __init__(self):
+        self._collector = None
+        self._archive = None
+        self._thread = None
+        self._done = threading.Event()
+        self._error = None
+        self._lock = threading.Lock()
+        self._discarded = False
+
+    def start(self):
+        tempfile = NamedTemporaryFile(suffix='.zip', delete=False)
+        tempfile.close()
+        self._archive = tempfile.name
+        self._collector = LogCollect()
+        self._done.clear()
+        self._error = None
+        self._discarded = False
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        background_priority()
+        try:
+            self._collector.write_logs(archive=self._archive, logbytes=0,
+                                       incremental=True, codec='auto',
+                                       fold=True,
+                                       budget=LOG_BUDGET - LOG_REFRESH_ROOM)
+        except Exception as error:
+            logging.error('report.precollect failed: %s', str(error))
+            self._error = error
+        with self._lock:
+            self._done.set()
+            if self._discarded:
+                os.remove(self._archive)
+
+    def take(self, timeout=None):
+        """
+        Return (collector, archive path) with the archive brought up to
+        date, waiting up to timeout seconds (PRECOLLECT_WAIT by default)
+        for it if it is still being built, or None if there is none by
+        then.  The archive then
+        belongs to the caller, and the next take() returns None until
+        start() is called again.
+        """
+        if self._thread is None:
+            return None
+        if timeout is None:
+            timeout = PRECOLLECT_WAIT
+        if not self._done.wait(timeout):
+            # Left to finish on its own, its archive is removed then
+            logging.error('report.precollect still running after %ds, '
+                          'not used', timeout)
+            self.discard()
+            return None
+        self._thread = None
+
+        collector, archive = self._collector, self._archive
+        self._collector = self._archive = None
+        try:
+            if self._error is not None:
+                raise self._error
+            collector.refresh_logs(archive, logbytes=0, budget=LOG_BUDGET)
+        except Exception as error:
+            logging.error('report.precollect not used: %s', str(error))
+            os.remove(archive)
+            return None
+        return collector, archive
+
+    def discard(self):
+        """Remove the archive if it was not taken, now or once it is
+        built, without waiting for that"""
+        if self._thread is None:
+            return
+        self._thread = None
+        with self._lock:
+            self._discarded = True
+            if self._done.is_set():
+                os.remove(self._archive)
+
+
+def send_report(data, outbox=None, progress=None, cancel=None,
+                precollector=None, metrics=None):
     """
     data: dict
         subject: str
@@ -33,41 +660,88 @@ def send_report(data):
                 path: str
                 name: str
                 type: str
+
+    outbox: Outbox to keep the report in if it cannot be sent now because
+            of a NetworkError or ServerError, which is raised all the same
+    progress: function called as progress(phase, done, total) while the
+              report is sent, phase being 'collect', 'upload' or
+              'ticket'; done and total count bytes, and are 0 when
+              unknown.  It is called from the sending thread(s).
+    cancel: threading.Event; once it is set, sending stops with
+            Cancelled at the next chance and nothing is kept
+    precollector: LogPrecollector started earlier, whose archive is used
+                  instead of collecting the logs now
+    metrics: Metrics to record the timings in, a new one by default;
+             either way it is saved once the report is done
+
+    Returns the list of (file, error) that could not be uploaded, as
+    deliver_report() does.
     """
-    tempfile = NamedTemporaryFile(delete=False)
-    tempfile.close()
+    # Fail on a broken configuration before the expensive log collection
+    get_config()
 
-    collector = LogCollect()
-    collector.write_logs(archive=tempfile.name, logbytes=0)
+    connections = connections_created()
+    data.setdefault('key', uuid.uuid4().hex)
+    if metrics is None:
+        metrics = Metrics(data['key'])
 
-    data['files'].append({'path': tempfile.name,
-                          'name': 'logs.zip',
-                          'type': 'application/zip'})
+    if progress is not None:
+        progress('collect', 0, 0)
 
-    uploads = []
+    # The attachments are on disk already, they are uploaded while the
+    # logs are collected, and the logs join them once they are archived.
+    pool = UploadPool(progress=progress, cancel=cancel, metrics=metrics,
+                      transform=_transform())
     for file in data['files']:
-        attachment = Attachment()
-        attachment.create(file['path'],
-                          file['name'],
-                          file['type'])
-        uploads.append(attachment.token())
+        pool.add(file)
 
-    os.remove(tempfile.name)
+    try:
+        with metrics.phase('collect'):
+            taken = None
+            if precollector is not None:
+                taken = precollector.take()
+            metrics.set('precollected', taken is not None)
+            if taken is not None:
+                collector, archive = taken
+            else:
+                collector, archive = collect_logs()
+    except Exception:
+        try:
+            pool.finish()
+        except Cancelled:
+            pass
+        raise
+    metrics.set('archive', collector.stats)
+
+    logs = {'path': archive,
+            'name': 'logs.zip',
+            'type': 'application/zip'}
+    data['files'].append(logs)
+    pool.add(logs)
 
-    helper = FieldHelper()
-    fields = []
     try:
-        fields.append(helper.get_field(2, data['school']))
-        fields.append(helper.get_field(4, data['phone']))
-        fields.append(helper.get_field(5, data['serial']))
-        fields.append(helper.get_field(6, data['build']))
+        failed = deliver_report(data, progress, cancel, metrics, pool)
+        metrics.set('result', 'sent')
+    except (NetworkError, ServerError) as error:
+        metrics.set('result', error.__class__.__name__)
+        if outbox is not None:
+            outbox.spool(data)
+            # The outbox has these logs now, they will not be lost
+            collector.commit_checkpoints()
+        raise
     except Exception as error:
-        logging.error('report.send_report missing ids: %s', str(error))
+        metrics.set('result', error.__class__.__name__)
+        raise
+    finally:
+        os.remove(archive)
+        metrics.set('connections', connections_created() - connections)
+        _save_metrics(metrics)
 
-    ticket = Ticket()
-    ticket.create(data['subject'],
-                  data['body'],
-                  uploads,
-                  data['name'],
-                  data['email'],
-                  fields)
+    logging.debug('report.send_report opened %d connection(s)',
+                  connections_created() - connections)
+
+    # Only now that the ticket exists can these logs count as reported.
+    if logs not in [file for file, error in failed]:
+        collector.commit_checkpoints()
+
+    return failed
@@ -209,17 +209,19 @@ class TaskMaster(Gtk.Alignment):
             self.completed = True
             self.task_button.set_label(_('Exit'))
 
-    def show_page(self, url):
+    def show_page(self, url, height=610):
             self._destroy_graphics()
             graphics = Graphics()
             self._graphics = graphics
             url = os.path.join(self.get_bundle_path(), 'html-content', url)
             self._graphics.add_uri(
                 'file://' + url + '?NAME=' + utils.get_safe_text(
-                    self.read_task_data(NAME_UID).replace(',', ' ')))
+                    self.read_task_data(NAME_UID).replace(',', ' ')),
+                height=height)
             self._graphics.set_zoom_level(0.667)
             self._graphics_grid.attach(self._graphics, 0, 0, 1, 1)
             self._graphics.show()
+            return self._graphics
 
     def enter_entered(self):
         ''' Enter was entered in a text entry '''
@@ -13,6 +13,7 @@
 import os
 import email.utils
 import re
+import threading
 from gettext import gettext as _
 
 from gi.repository import GObject
@@ -30,6 +31,7 @@ from graphics import Graphics, FONT_SIZES
 import utils
 from reporter import send_report
 from backend.zendesk import ConfigError, NetworkError, ServerError
+from backend.zendesk import Cancelled
 
 # These tasks are requirements for other tasks
 _ENTER_NAME_TASK = 'enter-name-task'
@@ -688,6 +690,10 @@ class Support7Task(HTMLTask):
         self._files = []
         self._mimetypes = []
         self._in_progress = False
+        self._progress_bar = None
+        self._cancel = None
+        self._phase = None
+        self._retry = False
 
     def get_requires(self):
         return [CONFIRMATION_TASK]
@@ -707,6 +713,13 @@ class Support7Task(HTMLTask):
         if self._task_master.completed:
             return True
 
+        if self._retry:
+            self._retry = False
+            self._task_master.activity.precollector.start()
+            # Back to the report, as it was before it was submitted
+            self._task_master.reload_graphics()
+            return False
+
         # So we don't try to send more than once...
         if self._in_progress:
             return False
@@ -748,43 +761,103 @@ class Support7Task(HTMLTask):
                 'build': utils.get_build_number(),
                 'files': files}
 
-        self._task_master.show_page('progress.html')
+        graphics = self._task_master.show_page('progress.html', height=400)
+        self._progress_bar = graphics.add_progress_bar()
+        graphics.add_button(_('Cancel'), self._cancel_cb)
         self._task_master.activity.busy_cursor()
         self._task_master.task_button.set_sensitive(False)
 
-        # A timeout seems to be needed for the progress page to appear.
-        # GObject.idle_add(self._send_report, data)
-        GObject.timeout_add(2000, self._send_report, data)
+        # The report is sent from a thread of its own, so the page stays
+        # responsive; it reports back through GObject.idle_add only.
+        self._cancel = threading.Event()
+        self._phase = None
+        thread = threading.Thread(target=self._send_report,
+                                  args=(data, self._cancel))
+        thread.daemon = True
+        thread.start()
         return False
 
-    def _send_report(self, data):
+    def _send_report(self, data, cancel):
+        outbox = self._task_master.activity.outbox
+        precollector = self._task_master.activity.precollector
         try:
-            send_report(data)
+            send_report(data, outbox, self._send_progress, cancel,
+                        precollector)
+            error = None
+        except Exception as e:
+            error = e
+        GObject.idle_add(self._report_done_cb, error)
+
+    def _send_progress(self, phase, done, total):
+        GObject.idle_add(self._progress_cb, phase, done, total)
+
+    def _progress_cb(self, phase, done, total):
+        if self._progress_bar is None:
+            return False
+        if phase != self._phase:
+            self._phase = phase
+            if not total:
+                GObject.timeout_add(200, self._pulse_cb, phase)
+        if phase == 'collect':
+            self._progress_bar.set_text(_('Collecting logs'))
+        elif phase == 'ticket':
+            self._progress_bar.set_text(_('Creating the report'))
+        if total:
+            self._progress_bar.set_fraction(min(1.0, done / float(total)))
+            self._progress_bar.set_text(_('Sending %d of %d KB') %
+                                        (done / 1024, total / 1024))
+        return False
+
+    def _pulse_cb(self, phase):
+        if self._progress_bar is None or self._phase != phase:
+            return False
+        self._progress_bar.pulse()
+        return True
+
+    def _cancel_cb(self, button):
+        self._cancel.set()
+        button.set_sensitive(False)
+        self._progress_bar.set_text(_('Cancelling'))
+
+    def _report_done_cb(self, error):
+        self._progress_bar = None
+        self._phase = None
+        self._task_master.activity.reset_cursor()
+
+        if isinstance(error, Cancelled):
+            _logger.debug('send report cancelled')
+            self._task_master.activity.precollector.start()
+            # Back to the report, as it was before it was submitted
+            self._task_master.reload_graphics()
+            return False
+
+        if error is None:
             # If we are successful, don't save the error report locally.
             self._task_master.write_task_data(ERROR_REPORT, '')
             self._task_master.show_page('completed.html')
-            self._task_master.task_button.set_label(_('Exit'))
-            self._task_master.task_button.set_sensitive(True)
-            self._task_master.completed = True
-        except ServerError as e:
-            _logger.error('send report failed: %s' % e)
+        elif isinstance(error, ServerError):
+            _logger.error('send report failed: %s' % error)
+            self._task_master.activity.outbox_sender.wake()
             self._task_master.show_page('server-error.html')
-            self._task_master.task_button.set_label(_('Exit'))
-            self._task_master.task_button.set_sensitive(True)
-            self._task_master.completed = True
-        except NetworkError as e:
-            _logger.error('send report failed: %s' % e)
+        elif isinstance(error, NetworkError):
+            _logger.error('send report failed: %s' % error)
+            self._task_master.activity.outbox_sender.wake()
             self._task_master.show_page('network-error.html')
-            self._task_master.task_button.set_label(_('Exit'))
-            self._task_master.task_button.set_sensitive(True)
-            self._task_master.completed = True
-        except ConfigError as e:
-            _logger.error('send report failed: %s' % e)
+        elif isinstance(error, ConfigError):
+            _logger.error('send report failed: %s' % error)
             self._task_master.show_page('config-error.html')
-            self._task_master.task_button.set_label(_('Exit'))
+        else:
+            # Neither sent nor in the outbox, so it must not be left
+            _logger.error('send report failed: %s' % error)
+            self._task_master.show_page('send-error.html')
+            self._retry = True
+            self._task_master.task_button.set_label(_('Try again'))
             self._task_master.task_button.set_sensitive(True)
-            self._task_master.completed = True
-        self._task_master.activity.reset_cursor()
+            return False
+        self._task_master.task_button.set_label(_('Exit'))
+        self._task_master.task_button.set_sensitive(True)
+        self._task_master.completed = True
+        return False
 
     def _upload_cb(self, widget, i):
         chooser = None
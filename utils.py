@@ -39,6 +39,8 @@ from sugar3.graphics.xocolor import XoColor
 from jarabe import config
 from jarabe.model import shell
 
+from backend.logcollect import MachineProperties
+
 import logging
 _logger = logging.getLogger('training-activity-testutils')
 
@@ -69,10 +71,6 @@ _DBUS_SERVICE = 'org.sugarlabs.SugarServices'
 _DBUS_SHELL_IFACE = 'org.sugarlabs.SugarServices'
 _DBUS_PATH = '/org/sugarlabs/SugarServices'
 
-_OFW_TREE = '/ofw'
-_PROC_TREE = '/proc/device-tree'
-_SN = 'serial-number'
-
 volume_monitor = None
 battery_model = None
 proxy = None
@@ -956,14 +954,8 @@ def nm_status():
 
 
 def get_serial_number():
-    serial_no = None
-    if os.path.exists(os.path.join(_OFW_TREE, _SN)):
-        serial_no = _read_file(os.path.join(_OFW_TREE, _SN))
-    elif os.path.exists(os.path.join(_PROC_TREE, _SN)):
-        serial_no = _read_file(os.path.join(_PROC_TREE, _SN))
-    if serial_no is None:
-        serial_no = 'unknown'
-    return serial_no
+    # The same cached mfg-data entry AboutPanel and laptop_info use
+    return MachineProperties().laptop_serial_number() or 'unknown'
 
 
 def get_build_number():